@@ -0,0 +1,169 @@
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2016 Hynek Schlawack
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Measure the per-call overhead of the aio and tx decorators.
+
+Every benchmark calls a function that does nothing, so the result is the cost
+of the instrumentation.  Compare against the ``baseline`` benchmarks to get
+the overhead, and against ``prometheus_client`` to see how we fare compared
+to the underlying library.
+
+Run it with::
+
+    $ python benchmarks/decorators.py -o decorators.json
+
+and compare two runs using::
+
+    $ python -m pyperf compare_to before.json after.json --table
+"""
+
+from __future__ import annotations
+
+import asyncio
+
+from time import perf_counter
+
+import pyperf
+
+from prometheus_client import Counter, Gauge, Histogram
+from twisted.internet.defer import succeed
+
+from prometheus_async import aio, tx
+
+
+HIST = Histogram("bench_seconds", "Benchmark histogram.", registry=None)
+COUNTER = Counter("bench_errors", "Benchmark counter.", registry=None)
+GAUGE = Gauge("bench_in_progress", "Benchmark gauge.", registry=None)
+
+
+async def noop():
+    pass
+
+
+def noop_sync():
+    pass
+
+
+def time_aio(loops, make_call):
+    """
+    Time *loops* awaits of the awaitables returned by *make_call*, all on
+    the same event loop.
+    """
+
+    async def run():
+        t0 = perf_counter()
+        for _ in range(loops):
+            await make_call()
+
+        return perf_counter() - t0
+
+    return asyncio.run(run())
+
+
+def time_sync(loops, call):
+    t0 = perf_counter()
+    for _ in range(loops):
+        call()
+
+    return perf_counter() - t0
+
+
+async def prometheus_client_time():
+    with HIST.time():
+        await noop()
+
+
+async def prometheus_client_count_exceptions():
+    with COUNTER.count_exceptions():
+        await noop()
+
+
+async def prometheus_client_track_inprogress():
+    with GAUGE.track_inprogress():
+        await noop()
+
+
+def add_aio_benchmarks(runner):
+    runner.bench_time_func("aio baseline", time_aio, noop)
+
+    for name, deco, metric, reference in (
+        ("time", aio.time, HIST, prometheus_client_time),
+        (
+            "count_exceptions",
+            aio.count_exceptions,
+            COUNTER,
+            prometheus_client_count_exceptions,
+        ),
+        (
+            "track_inprogress",
+            aio.track_inprogress,
+            GAUGE,
+            prometheus_client_track_inprogress,
+        ),
+    ):
+        runner.bench_time_func(
+            f"aio.{name} decorator", time_aio, deco(metric)(noop)
+        )
+        runner.bench_time_func(
+            f"aio.{name} future",
+            time_aio,
+            lambda deco=deco, metric=metric: deco(metric, noop()),
+        )
+        runner.bench_time_func(
+            f"aio prometheus_client {name}", time_aio, reference
+        )
+
+
+def add_tx_benchmarks(runner):
+    runner.bench_time_func("tx baseline", time_sync, noop_sync)
+    runner.bench_time_func(
+        "tx baseline Deferred", time_sync, lambda: succeed(None)
+    )
+
+    for name, deco, metric, reference in (
+        ("time", tx.time, HIST, HIST.time()),
+        (
+            "count_exceptions",
+            tx.count_exceptions,
+            COUNTER,
+            COUNTER.count_exceptions(),
+        ),
+        (
+            "track_inprogress",
+            tx.track_inprogress,
+            GAUGE,
+            GAUGE.track_inprogress(),
+        ),
+    ):
+        runner.bench_time_func(
+            f"tx.{name} decorator", time_sync, deco(metric)(noop_sync)
+        )
+        runner.bench_time_func(
+            f"tx.{name} Deferred",
+            time_sync,
+            lambda deco=deco, metric=metric: deco(metric, succeed(None)),
+        )
+        runner.bench_time_func(
+            f"tx prometheus_client {name}", time_sync, reference(noop_sync)
+        )
+
+
+if __name__ == "__main__":
+    runner = pyperf.Runner()
+    runner.metadata["description"] = __doc__.strip().splitlines()[0]
+
+    add_aio_benchmarks(runner)
+    add_tx_benchmarks(runner)
@@ -0,0 +1,332 @@
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2016 Hynek Schlawack
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Measure the scrape throughput and latency of prometheus_async.aio.web.
+
+Serves a synthetic registry using start_http_server() ("loop") or
+start_http_server_in_thread() ("thread"), scrapes it using concurrent
+aiohttp clients in a different thread, and reports:
+
+- requests per second,
+- latency percentiles,
+- the peak RSS of the process,
+- and how long the server's event loop was blocked per scrape.
+
+The blocking time is measured by a loop monitor on the server's event loop:
+the sum of the heartbeat lags is the time the loop couldn't run anything
+else.
+
+Without --series/--shape/--server, the whole matrix is run; each case in its
+own process, so the peak RSS of one doesn't spill into the next.  For
+example::
+
+    $ python benchmarks/scrape.py
+    $ python benchmarks/scrape.py --series 100000 --shape histograms \\
+        --server thread --render-in-thread
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import resource
+import statistics
+import subprocess
+import sys
+
+from time import perf_counter
+
+import aiohttp
+
+from prometheus_client import CollectorRegistry, Gauge, Histogram
+
+from prometheus_async import aio
+
+
+SERIES = (1_000, 10_000, 100_000)
+SHAPES = ("plain", "labels", "histograms")
+SERVERS = ("loop", "thread")
+
+# Label values per metric family for the labelled shapes.
+CHILDREN = 100
+# Samples of one histogram child with the default buckets: 15 buckets plus
+# +Inf, _count, _sum, and _created.
+HISTOGRAM_SAMPLES = 19
+HEARTBEAT = 0.001
+
+
+class PlainGauges:
+    def __init__(self, series):
+        self._gauges = []
+        for i in range(series):
+            g = Gauge(f"bench_gauge_{i}", "Gauge.", registry=None)
+            g.set(i)
+            self._gauges.append(g)
+
+    def collect(self):
+        for g in self._gauges:
+            yield from g.collect()
+
+
+def build_registry(series, shape):
+    """
+    Create a registry that exposes roughly *series* samples of *shape*.
+    """
+    registry = CollectorRegistry()
+
+    if shape == "plain":
+        # Registering is quadratic in prometheus_client, so bundle the
+        # gauges into one collector; the rendering is the same.
+        registry.register(PlainGauges(series))
+    elif shape == "labels":
+        for i in range(series // CHILDREN):
+            g = Gauge(
+                f"bench_gauge_{i}", "Gauge.", ["child"], registry=registry
+            )
+            for j in range(CHILDREN):
+                g.labels(str(j)).set(j)
+    else:
+        children = series // HISTOGRAM_SAMPLES
+        for i in range((children + CHILDREN - 1) // CHILDREN):
+            h = Histogram(
+                f"bench_histogram_{i}",
+                "Histogram.",
+                ["child"],
+                registry=registry,
+            )
+            for j in range(min(CHILDREN, children - i * CHILDREN)):
+                h.labels(str(j)).observe(j / CHILDREN)
+
+    return registry
+
+
+async def scrape(url, requests, concurrency):
+    """
+    Scrape *url* *requests* times using *concurrency* concurrent clients.
+
+    Return the number of exposed samples, the latencies, and the wall time.
+    """
+    latencies = []
+    remaining = itertools.count(requests, -1)
+
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=concurrency)
+    ) as session:
+        # Warm up and count what we're dealing with.
+        async with session.get(url) as resp:
+            body = await resp.read()
+        samples = sum(
+            1 for line in body.splitlines() if not line.startswith(b"#")
+        )
+
+        async def client():
+            while next(remaining) > 0:
+                start = perf_counter()
+                async with session.get(url) as resp:
+                    await resp.read()
+                latencies.append(perf_counter() - start)
+
+        start = perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        elapsed = perf_counter() - start
+
+    return samples, latencies, elapsed
+
+
+def scrape_in_thread(url, requests, concurrency):
+    return asyncio.to_thread(
+        lambda: asyncio.run(scrape(url, requests, concurrency))
+    )
+
+
+async def run_loop(registry, args, options):
+    server = await aio.web.start_http_server(
+        addr="127.0.0.1", registry=registry, **options
+    )
+    monitor_registry = CollectorRegistry()
+    monitor = await aio.start_loop_monitor(
+        interval=HEARTBEAT, registry=monitor_registry
+    )
+
+    result = await scrape_in_thread(
+        server.url + "metrics", args.requests, args.concurrency
+    )
+    blocked = monitor_registry.get_sample_value(
+        "asyncio_event_loop_lag_seconds_sum"
+    )
+
+    await monitor.close()
+    await server.close()
+
+    return (*result, blocked)
+
+
+def run_thread(registry, args, options):
+    server = aio.web.start_http_server_in_thread(
+        addr="127.0.0.1", registry=registry, **options
+    )
+    monitor_registry = CollectorRegistry()
+    monitor = asyncio.run_coroutine_threadsafe(
+        aio.start_loop_monitor(interval=HEARTBEAT, registry=monitor_registry),
+        server._loop,
+    ).result()
+
+    result = asyncio.run(
+        scrape(server.url + "metrics", args.requests, args.concurrency)
+    )
+    blocked = monitor_registry.get_sample_value(
+        "asyncio_event_loop_lag_seconds_sum"
+    )
+
+    asyncio.run_coroutine_threadsafe(monitor.close(), server._loop).result()
+    server.close()
+
+    return (*result, blocked)
+
+
+def peak_rss_mib():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    if sys.platform == "darwin":
+        rss /= 1024
+
+    return rss / 1024
+
+
+def run_case(args):
+    registry = build_registry(args.series, args.shape)
+    options = {
+        "render_in_thread": args.render_in_thread,
+        "stream": args.stream,
+        "prerender_interval": args.prerender_interval,
+    }
+
+    if args.server == "loop":
+        samples, latencies, elapsed, blocked = asyncio.run(
+            run_loop(registry, args, options)
+        )
+    else:
+        samples, latencies, elapsed, blocked = run_thread(
+            registry, args, options
+        )
+
+    percentiles = statistics.quantiles(latencies, n=100)
+
+    return {
+        "series": args.series,
+        "shape": args.shape,
+        "server": args.server,
+        "samples": samples,
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentiles[49] * 1000,
+        "p90_ms": percentiles[89] * 1000,
+        "p99_ms": percentiles[98] * 1000,
+        "peak_rss_mib": peak_rss_mib(),
+        # +1 for the warm-up scrape.
+        "blocked_ms_per_scrape": blocked / (len(latencies) + 1) * 1000,
+    }
+
+
+COLUMNS = (
+    ("series", 7, ""),
+    ("shape", 10, ""),
+    ("server", 6, ""),
+    ("samples", 7, ""),
+    ("rps", 8, ".1f"),
+    ("p50_ms", 8, ".2f"),
+    ("p90_ms", 8, ".2f"),
+    ("p99_ms", 8, ".2f"),
+    ("peak_rss_mib", 12, ".1f"),
+    ("blocked_ms_per_scrape", 21, ".2f"),
+)
+
+
+def print_header():
+    print(
+        " ".join(f"{name:>{width}}" for name, width, _ in COLUMNS), flush=True
+    )
+
+
+def print_row(result):
+    print(
+        " ".join(
+            f"{result[name]:>{width}{spec}}" for name, width, spec in COLUMNS
+        ),
+        flush=True,
+    )
+
+
+def run_matrix(argv):
+    print_header()
+    for series, shape, server in itertools.product(SERIES, SHAPES, SERVERS):
+        out = subprocess.run(  # noqa: S603
+            [
+                sys.executable,
+                __file__,
+                "--series",
+                str(series),
+                "--shape",
+                shape,
+                "--server",
+                server,
+                "--json",
+                *argv,
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        print_row(json.loads(out))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0]
+    )
+    parser.add_argument("--series", type=int, choices=SERIES)
+    parser.add_argument("--shape", choices=SHAPES)
+    parser.add_argument("--server", choices=SERVERS)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--render-in-thread", action="store_true")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--prerender-interval", type=float)
+    parser.add_argument(
+        "--json", action="store_true", help="Print the result as JSON."
+    )
+    args = parser.parse_args()
+
+    case = (args.series, args.shape, args.server)
+    if all(c is None for c in case):
+        # Pass the remaining options on to the cases.
+        run_matrix([a for a in sys.argv[1:] if a != "--json"])
+        return
+
+    if any(c is None for c in case):
+        parser.error("Pass all of --series, --shape, and --server, or none.")
+
+    result = run_case(args)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print_header()
+        print_row(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,13 +20,23 @@ asyncio-related functionality.
 
 from . import sd
 from ._decorators import count_exceptions, time, track_inprogress
+from ._loop import LoopMonitor, start_loop_monitor
 
 
-__all__ = ["count_exceptions", "sd", "time", "track_inprogress"]
+__all__ = [
+    "LoopMonitor",
+    "count_exceptions",
+    "sd",
+    "start_loop_monitor",
+    "time",
+    "track_inprogress",
+]
 
 try:
     from . import web
+    from ._middleware import metrics_middleware
+    from ._tracing import trace_config
 
-    __all__ += ["web"]
+    __all__ += ["metrics_middleware", "trace_config", "web"]
 except ImportError:
     pass
@@ -21,7 +21,9 @@ Decorators for asyncio.
 from __future__ import annotations
 
 from collections.abc import Awaitable
+from functools import wraps
 from time import perf_counter
+from types import FunctionType
 from typing import TYPE_CHECKING, Any, Callable, overload
 
 from wrapt import decorator
@@ -33,6 +35,33 @@ if TYPE_CHECKING:
     from ..types import Incrementer, Observer, P, R, T
 
 
+def _with_fast_path(
+    fast: Callable[[Callable[P, R]], Callable[P, R]],
+    generic: Callable[[Callable[P, R]], Callable[P, R]],
+) -> Callable[[Callable[P, R]], Callable[P, R]]:
+    """
+    Decorate plain functions using *fast* and everything else using
+    *generic*.
+
+    *fast* wraps using :func:`functools.wraps` which is considerably cheaper
+    per call than wrapt's dispatch, and plain functions don't need anything
+    else: they bind to instances like our wrapper does.  Everything else --
+    wrapt proxies from other decorators, descriptors like
+    :class:`classmethod`, or callable objects -- goes through wrapt which
+    keeps their binding behavior intact.
+
+    Use ``type()`` because wrapt's proxies lie about their ``__class__``.
+    """
+
+    def decorate(wrapped: Callable[P, R]) -> Callable[P, R]:
+        if type(wrapped) is FunctionType:
+            return fast(wrapped)
+
+        return generic(wrapped)
+
+    return decorate
+
+
 @overload
 def time(metric: Observer) -> Callable[[Callable[P, R]], Callable[P, R]]: ...
 
@@ -70,7 +99,18 @@ def time(
             finally:
                 observe(start_time)
 
-        return time_decorator
+        def time_fast(wrapped: Callable[P, R]) -> Callable[P, R]:
+            @wraps(wrapped)
+            async def timed(*args: P.args, **kwargs: P.kwargs) -> Any:
+                start_time = perf_counter()
+                try:
+                    return await wrapped(*args, **kwargs)
+                finally:
+                    metric.observe(perf_counter() - start_time)
+
+            return timed  # type: ignore[return-value]
+
+        return _with_fast_path(time_fast, time_decorator)
 
     f = future
 
@@ -128,7 +168,18 @@ def count_exceptions(
                 raise
             return rv
 
-        return count_decorator
+        def count_fast(wrapped: Callable[P, R]) -> Callable[P, R]:
+            @wraps(wrapped)
+            async def counted(*args: P.args, **kwargs: P.kwargs) -> Any:
+                try:
+                    return await wrapped(*args, **kwargs)
+                except exc:
+                    metric.inc()
+                    raise
+
+            return counted  # type: ignore[return-value]
+
+        return _with_fast_path(count_fast, count_decorator)
 
     f = future
 
@@ -180,7 +231,18 @@ def track_inprogress(
 
             return rv
 
-        return track_decorator
+        def track_fast(wrapped: Callable[P, R]) -> Callable[P, R]:
+            @wraps(wrapped)
+            async def tracked(*args: P.args, **kwargs: P.kwargs) -> Any:
+                metric.inc()
+                try:
+                    return await wrapped(*args, **kwargs)
+                finally:
+                    metric.dec()
+
+            return tracked  # type: ignore[return-value]
+
+        return _with_fast_path(track_fast, track_decorator)
 
     else:  # noqa: RET505
         f = future
@@ -0,0 +1,863 @@
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2016 Hynek Schlawack
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Rendering machinery behind :mod:`prometheus_async.aio.web`.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import copy
+import gzip
+import hashlib
+import importlib
+
+from bisect import bisect_left
+from collections import deque
+from contextlib import asynccontextmanager, suppress
+from functools import partial
+from time import monotonic, perf_counter
+from typing import TYPE_CHECKING, Any
+
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import GaugeMetricFamily
+
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Iterable, Iterator
+    from concurrent.futures import Executor
+    from typing import Callable
+
+    from prometheus_client import CollectorRegistry
+    from prometheus_client.metrics_core import Metric
+    from prometheus_client.registry import Collector
+
+
+def _count_series(body: bytes) -> int:
+    """
+    Count the samples in the exposition *body*: every line that's not a
+    comment.
+    """
+    return body.count(b"\n") - body.count(b"\n#") - body.startswith(b"#")
+
+
+def _load_zstd() -> Callable[..., bytes] | None:
+    """
+    Return a zstd compression function from the standard library (Python 3.14
+    and later) or the *zstandard* package, whichever is available first.
+    """
+    for mod in ("compression.zstd", "zstandard"):
+        with suppress(ImportError):
+            return importlib.import_module(mod).compress
+
+    return None
+
+
+_zstd_compress = _load_zstd()
+
+
+def _gzip(body: bytes, level: int | None) -> bytes:
+    # mtime=0 keeps the output deterministic for identical bodies.
+    return gzip.compress(
+        body, compresslevel=6 if level is None else level, mtime=0
+    )
+
+
+def _zstd(body: bytes, level: int | None) -> bytes:
+    if level is None:
+        return _zstd_compress(body)  # type: ignore[misc]
+
+    return _zstd_compress(body, level=level)  # type: ignore[misc]
+
+
+# Content-Encodings we can produce, in order of preference.
+ENCODERS: dict[str, Callable[[bytes, int | None], bytes]] = {"gzip": _gzip}
+if _zstd_compress is not None:
+    ENCODERS = {"zstd": _zstd, **ENCODERS}
+
+
+class _Families:
+    """
+    A collector that collects exactly *families*.
+    """
+
+    __slots__ = ("_families",)
+
+    def __init__(self, families: Iterable[Metric]) -> None:
+        self._families = families
+
+    def collect(self) -> Iterable[Metric]:
+        return self._families
+
+
+# prometheus_client before 0.9 doesn't index the bare names of families, so
+# look them up by the names of their samples, too.
+_SAMPLE_SUFFIXES = (
+    "_total",
+    "_created",
+    "_bucket",
+    "_count",
+    "_sum",
+    "_gcount",
+    "_gsum",
+    "_info",
+)
+
+
+class _Restricted:
+    """
+    A collector that collects only the samples of *registry* whose names are
+    in *names* or start with one of *prefixes*.
+
+    Collectors are looked up using the registry's index of metric names, so
+    collectors that can't contribute are never collected.  Collectors that
+    don't describe their metrics aren't in the index; they're always
+    collected and their output filtered.
+    """
+
+    def __init__(
+        self,
+        registry: CollectorRegistry,
+        names: Iterable[str],
+        prefixes: Iterable[str],
+    ) -> None:
+        self._registry = registry
+        self._names = frozenset(names)
+        self._prefixes = tuple(prefixes)
+
+    def _collectors(self) -> list[Collector]:
+        """
+        Look up the collectors that expose any of the selected names.
+        """
+        registry = self._registry
+        try:
+            with registry._lock:
+                index = registry._names_to_collectors
+                registered = list(registry._collector_to_names.items())
+                collectors = set()
+                for name in self._names:
+                    for n in (name, *(name + s for s in _SAMPLE_SUFFIXES)):
+                        if n in index:
+                            collectors.add(index[n])
+                            break
+                if self._prefixes:
+                    names = sorted(index)
+                    for prefix in self._prefixes:
+                        i = bisect_left(names, prefix)
+                        while i < len(names) and names[i].startswith(prefix):
+                            collectors.add(index[names[i]])
+                            i += 1
+
+                target_info = (
+                    registry._target_info_metric()  # type: ignore[no-untyped-call]
+                    if getattr(registry, "_target_info", None)
+                    else None
+                )
+        except AttributeError:
+            # Not a CollectorRegistry; filter everything it collects.
+            return [registry]
+
+        # Keep the registration order to keep the output stable.
+        ordered: list[Collector] = [
+            c for c, names in registered if not names or c in collectors
+        ]
+        if target_info is not None:
+            ordered.insert(0, _Families((target_info,)))
+
+        return ordered
+
+    def _wanted(self, name: str) -> bool:
+        return name in self._names or name.startswith(self._prefixes)
+
+    def collect(self) -> Iterator[Metric]:
+        for collector in self._collectors():
+            for family in collector.collect():
+                if self._wanted(family.name):
+                    yield family
+                    continue
+
+                samples = [s for s in family.samples if self._wanted(s.name)]
+                if samples:
+                    restricted = copy.copy(family)
+                    restricted.samples = samples
+                    yield restricted
+
+
+class _CollectorTimings:
+    """
+    A collector that exposes how long each collector of a registry took to
+    collect and encode during the latest instrumented render.
+    """
+
+    def __init__(self) -> None:
+        self.latest: dict[str, list[float]] = {}
+
+    def describe(self) -> Iterable[Metric]:
+        return [self._family()]
+
+    def collect(self) -> Iterable[Metric]:
+        family = self._family()
+        for name, (collect, encode) in self.latest.items():
+            family.add_metric([name, "collect"], collect)
+            family.add_metric([name, "encode"], encode)
+
+        return [family]
+
+    def _family(self) -> GaugeMetricFamily:
+        return GaugeMetricFamily(
+            "prometheus_async_collector_duration_seconds",
+            "Time spent collecting and encoding the metrics of a collector "
+            "during the latest render.",
+            labels=["collector", "phase"],
+        )
+
+
+def _collector_key(collector: Collector) -> str:
+    """
+    Name *collector* by the first family it describes, or -- if it doesn't
+    describe itself -- by its class.
+    """
+    describe = getattr(collector, "describe", None)
+    if describe is not None:
+        for family in describe():
+            return str(family.name)
+
+    return type(collector).__qualname__
+
+
+def _timed_families(
+    registry: CollectorRegistry,
+    durations: dict[str, list[float]],
+) -> Iterator[tuple[Metric, list[float] | None]]:
+    """
+    Yield the families of *registry* collector by collector, together with
+    the durations entry of their collector.
+
+    Collectors are keyed by :func:`_collector_key`; if several collectors end
+    up with the same key, the later ones are numbered in registration order.
+
+    Collection times are added to the first item of the durations entries,
+    the caller is expected to add the encoding times to the second.
+    """
+    try:
+        with registry._lock:
+            collectors = list(registry._collector_to_names)
+            target_info = (
+                registry._target_info_metric()  # type: ignore[no-untyped-call]
+                if getattr(registry, "_target_info", None)
+                else None
+            )
+    except AttributeError:
+        # Not a CollectorRegistry; treat it as a single collector.
+        collectors = [registry]
+        target_info = None
+
+    if target_info is not None:
+        yield target_info, None
+
+    seen: dict[str, int] = {}
+    for collector in collectors:
+        key = _collector_key(collector)
+        seen[key] = n = seen.get(key, 0) + 1
+        if n > 1:
+            key = f"{key}-{n}"
+        entry = durations.setdefault(key, [0.0, 0.0])
+        start = perf_counter()
+        families = list(collector.collect())
+        entry[0] += perf_counter() - start
+
+        for family in families:
+            yield family, entry
+
+
+def _iter_chunks(
+    registry: CollectorRegistry,
+    generate: Callable,
+    size: int = 64 * 1024,
+    durations: dict[str, list[float]] | None = None,
+) -> Iterator[bytes]:
+    """
+    Yield the exposition created by *generate* in chunks of roughly *size*
+    bytes.
+
+    The families are encoded one at a time, so a chunk is only larger than
+    *size* if a single family is.  The end of the exposition -- if the format
+    has one -- is yielded as a chunk of its own.
+
+    If *durations* is passed, the time spent collecting and encoding is
+    recorded per collector.
+    """
+    # Each call to *generate* terminates the exposition -- which is a no-op
+    # for the text format, but adds an "# EOF" line to OpenMetrics.
+    eof = generate(_Families(()))
+
+    families: Iterable[tuple[Metric, list[float] | None]] = (
+        ((family, None) for family in registry.collect())
+        if durations is None
+        else _timed_families(registry, durations)
+    )
+
+    buf: list[bytes] = []
+    buf_size = 0
+    for family, entry in families:
+        if entry is None:
+            chunk = generate(_Families((family,)))[: -len(eof) or None]
+        else:
+            start = perf_counter()
+            chunk = generate(_Families((family,)))[: -len(eof) or None]
+            entry[1] += perf_counter() - start
+        buf.append(chunk)
+        buf_size += len(chunk)
+        if buf_size >= size:
+            yield b"".join(buf)
+            buf = []
+            buf_size = 0
+
+    if buf:
+        yield b"".join(buf)
+    if eof:
+        yield eof
+
+
+def _truncated(generate: Callable, chunks: list[bytes]) -> bytes:
+    """
+    Finish the partial exposition *chunks* by *generate* with a marker
+    metric.
+    """
+    eof = generate(_Families(()))
+    if eof and chunks and chunks[-1] == eof:
+        chunks = chunks[:-1]
+
+    return b"".join(chunks) + generate(
+        _Families(
+            (
+                GaugeMetricFamily(
+                    "prometheus_async_scrape_truncated",
+                    "The rendering didn't finish before the scrape timeout "
+                    "and the exposition is incomplete.",
+                    value=1,
+                ),
+            )
+        )
+    )
+
+
+def _digest(body: bytes) -> str:
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def _register(registry: CollectorRegistry, *collectors: Collector) -> None:
+    """
+    Register *collectors* with *registry* unless they already are.
+    """
+    for c in collectors:
+        with suppress(ValueError):
+            registry.register(c)
+
+
+def _unregister(registry: CollectorRegistry, *collectors: Collector) -> None:
+    """
+    Unregister *collectors* from *registry* if they are registered.
+    """
+    for c in collectors:
+        with suppress(KeyError):
+            registry.unregister(c)
+
+
+class _OverloadedError(Exception):
+    """
+    All render slots are busy and the queue is full.
+    """
+
+
+class _Limiter:
+    """
+    Admit at most *limit* concurrent renders and let at most *max_queued* more
+    wait for a slot.
+    """
+
+    def __init__(self, limit: int, max_queued: int) -> None:
+        self._limit = limit
+        self._max_queued = max_queued
+        self._active = 0
+        self._waiters: deque[asyncio.Future[None]] = deque()
+
+        self.queued = Counter(
+            "prometheus_async_scrapes_queued",
+            "Scrapes that had to wait for a free render slot.",
+            registry=None,
+        )
+        self.rejected = Counter(
+            "prometheus_async_scrapes_rejected",
+            "Scrapes that were rejected because all render slots were busy "
+            "and the queue was full.",
+            registry=None,
+        )
+
+    async def acquire(self) -> None:
+        """
+        Wait for a slot.
+
+        :raises _OverloadedError: If the queue is full.
+        """
+        if self._active < self._limit and not self._waiters:
+            self._active += 1
+            return
+
+        if len(self._waiters) >= self._max_queued:
+            self.rejected.inc()
+            raise _OverloadedError
+
+        self.queued.inc()
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.cancelled():
+                # release() may have skipped and dropped us already.
+                with suppress(ValueError):
+                    self._waiters.remove(fut)
+            else:
+                # We've been handed a slot, but we can't use it anymore.
+                self.release()
+            raise
+
+    def release(self) -> None:
+        """
+        Hand our slot to the next waiter or free it.
+        """
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+
+        self._active -= 1
+
+
+class _Snapshot:
+    """
+    A rendered exposition together with its cached encoded variants.
+    """
+
+    __slots__ = ("body", "digest", "encoded", "rendered_at")
+
+    def __init__(self, body: bytes) -> None:
+        self.body = body
+        self.digest: str | None = None
+        self.encoded: dict[tuple[str, int | None], asyncio.Task[bytes]] = {}
+        self.rendered_at = monotonic()
+
+    @property
+    def age(self) -> float:
+        """
+        Seconds since the snapshot has been rendered.
+        """
+        return monotonic() - self.rendered_at
+
+
+class _Renderer:
+    """
+    Render the exposition of *registry*.
+
+    Renders are single-flight per format: scrapes that arrive while a render
+    of the same format is running wait for it and share its snapshot.
+
+    If *keep_latest* is True, the latest snapshot of each format is kept and
+    if a render comes out identical to it, it -- and thus its encoded
+    variants and digest -- are reused.  Pre-rendering and off-loop rendering
+    need the latest snapshot, too, and keep it regardless.
+
+    If *executor* is passed, rendering and compressing happens there instead
+    of blocking the event loop, and the time spent is measured.
+
+    If *prerender_interval* is passed, every format that has been rendered
+    before is re-rendered in the background every *prerender_interval*
+    seconds between :meth:`start` and :meth:`close`, and :meth:`render`
+    returns the latest snapshot unless it's older than *max_staleness*
+    seconds.
+
+    If *collector_timing* is True, the time spent in each collector is
+    recorded in :attr:`timings`, which is a metric, too.
+
+    If *max_concurrent_renders* is passed, at most that many renders run at
+    the same time, and at most *max_queued_scrapes* scrapes wait for a slot.
+    Excess scrapes raise :class:`_OverloadedError`.  Joining a render that is
+    already in flight is always possible.
+
+    The metrics about the enabled features are in :attr:`metrics`.  They
+    belong to this renderer alone and are created only if the feature is
+    enabled -- in multiprocess mode, creating a metric creates its file.
+    It's up to the caller to register them.
+    """
+
+    def __init__(
+        self,
+        registry: CollectorRegistry,
+        *,
+        executor: Executor | None = None,
+        prerender_interval: float | None = None,
+        max_staleness: float | None = None,
+        collector_timing: bool = False,
+        max_concurrent_renders: int | None = None,
+        max_queued_scrapes: int = 0,
+        keep_latest: bool = False,
+    ) -> None:
+        self._registry = registry
+        self._executor = executor
+        self._prerender_interval = prerender_interval
+        self._max_staleness = max_staleness
+        self._prerender_task: asyncio.Task[None] | None = None
+        self._in_flight: dict[Callable, asyncio.Task[_Snapshot]] = {}
+        self._latest: dict[Callable, _Snapshot] = {}
+        self._keep_latest = (
+            keep_latest
+            or executor is not None
+            or prerender_interval is not None
+        )
+        self._progress: dict[Callable, list[bytes]] = {}
+
+        self.metrics: list[Collector] = []
+
+        self._render_duration: Histogram | None = None
+        self._render_queued: Histogram | None = None
+        self._truncated: Counter | None = None
+        if executor is not None:
+            self._render_duration = Histogram(
+                "prometheus_async_render_duration_seconds",
+                "Time spent rendering the metrics exposition.",
+                registry=None,
+            )
+            self._render_queued = Histogram(
+                "prometheus_async_render_queued_seconds",
+                "Time renders spent waiting for an executor worker.",
+                registry=None,
+            )
+            self._truncated = Counter(
+                "prometheus_async_scrape_deadline_exceeded",
+                "Scrapes that were answered with a stale or partial "
+                "exposition because rendering didn't finish before the "
+                "scrape timeout.",
+                ["served"],
+                registry=None,
+            )
+            self.metrics += [
+                self._render_duration,
+                self._render_queued,
+                self._truncated,
+            ]
+
+        self._limiter: _Limiter | None = None
+        if max_concurrent_renders is not None:
+            self._limiter = _Limiter(
+                max_concurrent_renders, max_queued_scrapes
+            )
+            self.metrics += [self._limiter.queued, self._limiter.rejected]
+
+        self.timings: _CollectorTimings | None = None
+        if collector_timing:
+            self.timings = _CollectorTimings()
+            self.metrics.append(self.timings)
+
+    async def start(self) -> None:
+        """
+        Start pre-rendering in the background, if configured.
+        """
+        if self._prerender_interval is not None:
+            self._prerender_task = asyncio.get_running_loop().create_task(
+                self._prerender(self._prerender_interval)
+            )
+
+    async def close(self) -> None:
+        """
+        Stop pre-rendering.
+        """
+        if self._prerender_task is not None:
+            self._prerender_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._prerender_task
+            self._prerender_task = None
+
+    async def render(
+        self, generate: Callable, timeout: float | None = None
+    ) -> _Snapshot:
+        """
+        Return a snapshot of the exposition created by *generate*.
+
+        If pre-rendering is active, that's the latest snapshot -- as long as
+        it's fresh enough.
+
+        If the render takes longer than *timeout* seconds, return the last
+        good snapshot or -- if there's none -- what has been rendered so far
+        with a marker metric.  The render itself carries on for the next
+        scrape.
+        """
+        if self._prerender_task is not None:
+            latest = self._latest.get(generate)
+            if latest is not None and (
+                self._max_staleness is None
+                or latest.age <= self._max_staleness
+            ):
+                return latest
+
+        return await self.refresh(generate, timeout)
+
+    async def refresh(
+        self, generate: Callable, timeout: float | None = None
+    ) -> _Snapshot:
+        """
+        Return a fresh snapshot of the exposition created by *generate*.
+
+        For *timeout* see :meth:`render`.
+        """
+        loop = asyncio.get_running_loop()
+        task = self._in_flight.get(generate)
+        if task is None or task.get_loop() is not loop:
+            if self._limiter is not None:
+                await self._limiter.acquire()
+
+                # Somebody else may have started a render while we waited.
+                task = self._in_flight.get(generate)
+                if task is not None and task.get_loop() is loop:
+                    self._limiter.release()
+
+            if task is None or task.get_loop() is not loop:
+                task = loop.create_task(self._snapshot(generate))
+                task.add_done_callback(partial(self._forget, generate))
+                self._in_flight[generate] = task
+
+        # Shielded, so a scraper going away or timing out doesn't cancel the
+        # render for everybody else waiting for it.
+        if self._truncated is None:
+            # Renders on the loop can't be interrupted anyway.
+            return await asyncio.shield(task)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        latest = self._latest.get(generate)
+        if latest is not None:
+            self._truncated.labels("stale").inc()
+            return latest
+
+        progress = self._progress.get(generate)
+        if progress is not None:
+            self._truncated.labels("partial").inc()
+            return _Snapshot(_truncated(generate, progress[:]))
+
+        return await asyncio.shield(task)
+
+    async def encode(
+        self, snapshot: _Snapshot, encoding: str, level: int | None
+    ) -> bytes:
+        """
+        Return *snapshot*'s body encoded using *encoding* at *level*.
+
+        The result is cached on *snapshot*.
+        """
+        key = (encoding, level)
+        task = snapshot.encoded.get(key)
+        if task is None:
+            task = asyncio.ensure_future(
+                self._run(ENCODERS[encoding], snapshot.body, level)
+            )
+            snapshot.encoded[key] = task
+
+        return await asyncio.shield(task)
+
+    async def digest(self, snapshot: _Snapshot) -> str:
+        """
+        Return a hash of *snapshot*'s body.
+
+        The result is cached on *snapshot*.
+        """
+        if snapshot.digest is None:
+            snapshot.digest = await self._run(_digest, snapshot.body)
+
+        return snapshot.digest
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """
+        Hold a render slot, if renders are limited.
+
+        :raises _OverloadedError: If there's no free slot.
+        """
+        if self._limiter is None:
+            yield
+            return
+
+        await self._limiter.acquire()
+        try:
+            yield
+        finally:
+            self._limiter.release()
+
+    async def render_restricted(
+        self,
+        generate: Callable,
+        names: Iterable[str],
+        prefixes: Iterable[str],
+    ) -> _Snapshot:
+        """
+        Return a snapshot of only the metrics whose names are in *names* or
+        start with one of *prefixes*.
+
+        Restricted renders are neither coalesced nor cached.
+        """
+        async with self.slot():
+            return _Snapshot(
+                await self._run(
+                    generate, _Restricted(self._registry, names, prefixes)
+                )
+            )
+
+    async def stream(
+        self,
+        generate: Callable,
+        names: Iterable[str] = (),
+        prefixes: Iterable[str] = (),
+    ) -> AsyncIterator[bytes]:
+        """
+        Yield the exposition created by *generate* in chunks.
+
+        If *names* or *prefixes* are passed, the exposition is restricted
+        like in :meth:`render_restricted`.
+
+        Streams are neither coalesced nor cached, and callers are responsible
+        for holding a :meth:`slot`.
+        """
+        registry = self._registry
+        if names or prefixes:
+            # _iter_chunks() treats anything that's not a registry as a
+            # single collector.
+            registry = _Restricted(  # type: ignore[assignment]
+                self._registry, names, prefixes
+            )
+
+        durations: dict[str, list[float]] | None = (
+            None
+            if self.timings is None or registry is not self._registry
+            else {}
+        )
+        chunks = _iter_chunks(registry, generate, durations=durations)
+        while (chunk := await self._run(next, chunks, None)) is not None:
+            yield chunk
+
+        if self.timings is not None and durations is not None:
+            self.timings.latest = durations
+
+    async def _snapshot(self, generate: Callable) -> _Snapshot:
+        body = await self._generate(generate)
+        if not self._keep_latest:
+            return _Snapshot(body)
+
+        latest = self._latest.get(generate)
+        if latest is not None and latest.body == body:
+            latest.rendered_at = monotonic()
+            return latest
+
+        snapshot = self._latest[generate] = _Snapshot(body)
+
+        return snapshot
+
+    async def _prerender(self, interval: float) -> None:
+        while True:
+            start = monotonic()
+            for generate in list(self._latest):
+                # A failed render is retried in the next round; scrapes that
+                # find the snapshot too stale surface the error.
+                with suppress(Exception):
+                    await self.refresh(generate)
+
+            await asyncio.sleep(max(0.0, interval - (monotonic() - start)))
+
+    async def _run(self, fn: Callable, *args: object) -> Any:
+        if self._executor is None:
+            return fn(*args)
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, fn, *args
+        )
+
+    async def _generate(self, generate: Callable) -> bytes:
+        if self._executor is None:
+            return self._timed_generate(generate, None, None)
+
+        # Off the loop, scrapes can time out while we render, so keep track of
+        # the progress to be able to serve a partial exposition.
+        progress: list[bytes] = []
+        self._progress[generate] = progress
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                self._timed_generate,
+                generate,
+                perf_counter(),
+                progress,
+            )
+        finally:
+            if self._progress.get(generate) is progress:
+                del self._progress[generate]
+
+    def _timed_generate(
+        self,
+        generate: Callable,
+        queued_at: float | None,
+        progress: list[bytes] | None,
+    ) -> bytes:
+        start = perf_counter()
+        if queued_at is not None and self._render_queued is not None:
+            self._render_queued.observe(start - queued_at)
+        try:
+            durations: dict[str, list[float]] | None = None
+            if self.timings is not None:
+                durations = {}
+            elif progress is None:
+                return generate(self._registry)
+
+            if progress is None:
+                progress = []
+
+            for chunk in _iter_chunks(
+                self._registry, generate, durations=durations
+            ):
+                progress.append(chunk)
+
+            if self.timings is not None and durations is not None:
+                self.timings.latest = durations
+
+            return b"".join(progress)
+        finally:
+            if self._render_duration is not None:
+                self._render_duration.observe(perf_counter() - start)
+
+    def _forget(
+        self, generate: Callable, task: asyncio.Task[_Snapshot]
+    ) -> None:
+        if self._in_flight.get(generate) is task:
+            del self._in_flight[generate]
+        if self._limiter is not None:
+            self._limiter.release()
+
+        # All waiters may be gone by now; don't let asyncio complain about a
+        # never-retrieved exception.
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,175 @@
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2016 Hynek Schlawack
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Event loop health monitoring.
+"""
+
+from __future__ import annotations
+
+import asyncio
+
+from itertools import chain
+from typing import TYPE_CHECKING
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from prometheus_client import CollectorRegistry
+    from prometheus_client.metrics_core import Metric
+
+
+_LAG_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class LoopMonitor:
+    """
+    A running event loop monitor.
+
+    Returned by :func:`start_loop_monitor`.  Do *not* instantiate it yourself.
+
+    It's a collector, registered with the registry passed to
+    :func:`start_loop_monitor`.
+
+    .. versionadded:: 26.2.0
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        interval: float,
+        late_threshold: float,
+        registry: CollectorRegistry | None,
+    ) -> None:
+        self._loop = loop
+        self._interval = interval
+        self._late_threshold = late_threshold
+        self._registry = registry
+
+        self._lag = Histogram(
+            "asyncio_event_loop_lag_seconds",
+            "How late the event loop ran a heartbeat callback.",
+            buckets=_LAG_BUCKETS,
+            registry=None,
+        )
+        self._tasks = Gauge(
+            "asyncio_event_loop_tasks",
+            "Number of unfinished tasks on the event loop.",
+            registry=None,
+        )
+        self._tasks.set_function(lambda: len(asyncio.all_tasks(loop)))
+        self._late = Counter(
+            "asyncio_event_loop_late_heartbeats",
+            "Heartbeats that ran later than the late threshold.",
+            registry=None,
+        )
+
+        # Register first, so a failed registration leaves no heartbeat behind.
+        if registry is not None:
+            registry.register(self)
+
+        self._expected = loop.time() + interval
+        self._handle: asyncio.TimerHandle | None = loop.call_later(
+            interval, self._beat
+        )
+
+    def _beat(self) -> None:
+        now = self._loop.time()
+        lag = max(0.0, now - self._expected)
+
+        self._lag.observe(lag)
+        if lag > self._late_threshold:
+            self._late.inc()
+
+        self._expected = now + self._interval
+        self._handle = self._loop.call_later(self._interval, self._beat)
+
+    def describe(self) -> Iterable[Metric]:
+        return self.collect()
+
+    def collect(self) -> Iterable[Metric]:
+        return chain(
+            self._lag.collect(), self._tasks.collect(), self._late.collect()
+        )
+
+    async def close(self) -> None:
+        """
+        Stop monitoring and unregister from the registry.
+        """
+        if self._handle is None:
+            return
+
+        self._handle.cancel()
+        self._handle = None
+
+        if self._registry is not None:
+            self._registry.unregister(self)
+
+
+async def start_loop_monitor(
+    *,
+    interval: float = 0.5,
+    late_threshold: float = 0.1,
+    registry: CollectorRegistry | None = REGISTRY,
+) -> LoopMonitor:
+    """
+    Start monitoring the health of the running event loop.
+
+    Every *interval* seconds, a heartbeat callback is scheduled and the
+    following metrics are updated:
+
+    - ``asyncio_event_loop_lag_seconds``: a histogram of how late the
+      heartbeat ran.  If the loop is starved by blocking code, every other
+      callback waits this long, too.
+    - ``asyncio_event_loop_late_heartbeats_total``: the number of heartbeats
+      that were late by more than *late_threshold* seconds -- whether it's
+      one slow callback or many short ones that held them up.
+
+    Additionally, ``asyncio_event_loop_tasks`` is the number of unfinished
+    tasks when the metrics are collected.
+
+    The heartbeat is a plain timer callback that doesn't create any tasks,
+    so its overhead is negligible.
+
+    :param float interval: Seconds between heartbeats.
+    :param float late_threshold: Lag in seconds beyond which a heartbeat
+        counts as late.
+    :param prometheus_client.CollectorRegistry registry: Where to register
+        the metrics.  ``None`` means not to register them at all.
+
+    :rtype: LoopMonitor
+
+    .. versionadded:: 26.2.0
+    """
+    return LoopMonitor(
+        asyncio.get_running_loop(), interval, late_threshold, registry
+    )
@@ -0,0 +1,163 @@
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2016 Hynek Schlawack
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+aiohttp server middleware that instruments requests.
+"""
+
+from __future__ import annotations
+
+from time import perf_counter
+from typing import TYPE_CHECKING
+
+from aiohttp import web
+from prometheus_client import REGISTRY, Gauge, Histogram
+
+
+if TYPE_CHECKING:
+    from aiohttp.typedefs import Handler, Middleware
+    from prometheus_client import CollectorRegistry
+
+
+_SIZE_BUCKETS = [64 * 4**i for i in range(10)]
+# Request methods are chosen by the client; everything else is "other".
+_METHODS = frozenset(
+    {
+        "CONNECT",
+        "DELETE",
+        "GET",
+        "HEAD",
+        "OPTIONS",
+        "PATCH",
+        "POST",
+        "PUT",
+        "TRACE",
+    }
+)
+
+
+def _route(request: web.Request) -> str:
+    """
+    Return a low-cardinality name for the route that matched *request*: its
+    name, its canonical path, or an empty string if nothing matched.
+    """
+    route = request.match_info.route
+    if route.name is not None:
+        return route.name
+
+    resource = route.resource
+    if resource is None:
+        return ""
+
+    return resource.canonical
+
+
+def metrics_middleware(
+    *,
+    registry: CollectorRegistry | None = REGISTRY,
+    namespace: str = "aiohttp",
+) -> Middleware:
+    """
+    Create an aiohttp server middleware that records request durations,
+    requests in progress, and response sizes.
+
+    The metrics are labelled by *route*, *method*, and -- except for the
+    requests in progress -- *status*.  *route* is the name of the route that
+    matched or -- if it doesn't have one -- its canonical path, like
+    ``/users/{id}``.  Raw request paths are never used, to keep the number of
+    series bounded.  Requests that didn't match any route have an empty
+    *route*.  For the same reason, *method* is ``other`` for anything but the
+    standard HTTP methods.
+
+    The labelled metrics are cached per label values, so recording a request
+    doesn't have to look them up again.
+
+    Response sizes are only recorded for responses with a known content
+    length; streamed responses usually don't have one.
+
+    :param prometheus_client.CollectorRegistry registry: Where to register
+        the metrics.  ``None`` means not to register them at all.
+    :param str namespace: Prefix of the metric names.
+
+    :returns: A middleware you can pass to :class:`aiohttp.web.Application`.
+
+    .. versionadded:: 26.2.0
+    """
+    duration = Histogram(
+        f"{namespace}_request_duration_seconds",
+        "Time spent handling requests.",
+        ["route", "method", "status"],
+        registry=registry,
+    )
+    in_progress = Gauge(
+        f"{namespace}_requests_in_progress",
+        "Requests that are currently being handled.",
+        ["route", "method"],
+        registry=registry,
+    )
+    size = Histogram(
+        f"{namespace}_response_size_bytes",
+        "Size of response bodies.",
+        ["route", "method", "status"],
+        buckets=_SIZE_BUCKETS,
+        registry=registry,
+    )
+
+    in_progress_children: dict[tuple[str, str], Gauge] = {}
+    children: dict[tuple[str, str, int], tuple[Histogram, Histogram]] = {}
+
+    @web.middleware
+    async def middleware(
+        request: web.Request, handler: Handler
+    ) -> web.StreamResponse:
+        route = _route(request)
+        method = request.method if request.method in _METHODS else "other"
+
+        gauge = in_progress_children.get((route, method))
+        if gauge is None:
+            gauge = in_progress_children[route, method] = in_progress.labels(
+                route, method
+            )
+
+        gauge.inc()
+        start = perf_counter()
+        status = 500
+        content_length = None
+        try:
+            response = await handler(request)
+            status = response.status
+            content_length = response.content_length
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            elapsed = perf_counter() - start
+            gauge.dec()
+
+            key = (route, method, status)
+            observers = children.get(key)
+            if observers is None:
+                observers = children[key] = (
+                    duration.labels(route, method, status),
+                    size.labels(route, method, status),
+                )
+
+            observers[0].observe(elapsed)
+            if content_length is not None:
+                observers[1].observe(content_length)
+
+        return response
+
+    return middleware
@@ -0,0 +1,159 @@
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2016 Hynek Schlawack
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Multiprocess-mode collection that only re-parses files that changed.
+"""
+
+from __future__ import annotations
+
+import glob
+import os
+import struct
+
+from typing import TYPE_CHECKING, BinaryIO
+
+from prometheus_client.metrics_core import Metric
+from prometheus_client.multiprocess import MultiProcessCollector
+
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+
+# The first 4 bytes of an mmap file are the number of bytes in use.
+_USED = struct.Struct("i")
+
+
+class _ParsedFile:
+    """
+    The metrics parsed from a single mmap file and the used part of the
+    file they were parsed from.
+    """
+
+    __slots__ = ("data", "metrics", "stat")
+
+    def __init__(
+        self, stat: tuple[int, int], data: bytes, metrics: dict[str, Metric]
+    ) -> None:
+        self.stat = stat
+        self.data = data
+        self.metrics = metrics
+
+
+class _CachedMultiProcessCollector:
+    """
+    Like :class:`prometheus_client.multiprocess.MultiProcessCollector`, but
+    remembers what it parsed per file and only re-parses files that changed.
+
+    A file is considered unchanged if its modification time and size are
+    unchanged *and* its contents are, too: the kernel doesn't update the
+    modification time of memory-mapped files on every write.  Only the used
+    part of the files is read and compared, which is still much cheaper than
+    parsing them.
+    """
+
+    def __init__(self, path: str | None = None) -> None:
+        if path is None:
+            # prometheus_client before 0.10 only knows the lowercase name.
+            path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+            if not path:
+                path = os.environ.get("prometheus_multiproc_dir")  # noqa: SIM112
+        if not path or not os.path.isdir(path):
+            msg = "env PROMETHEUS_MULTIPROC_DIR is not set or not a directory"
+            raise ValueError(msg)
+
+        self._path = path
+        self._files: dict[str, _ParsedFile] = {}
+        self._merged: Iterable[Metric] = ()
+
+    def collect(self) -> Iterable[Metric]:
+        files = sorted(glob.glob(os.path.join(self._path, "*.db")))
+
+        changed = set(self._files) != set(files)
+        for f in files:
+            changed |= self._refresh(f)
+
+        for f in set(self._files) - set(files):
+            del self._files[f]
+
+        if changed:
+            self._merged = _merge(
+                [p.metrics for f, p in sorted(self._files.items())]
+            )
+
+        return self._merged
+
+    def _refresh(self, f: str) -> bool:
+        """
+        Re-parse *f* if it changed.
+
+        :returns: Whether *f* changed.
+        """
+        try:
+            st = os.stat(f)
+            with open(f, "rb") as fh:
+                data = _read_used(fh)
+        except FileNotFoundError:
+            # Gone since the glob; e.g. removed by mark_process_dead().
+            self._files.pop(f, None)
+            return True
+
+        stat = (st.st_mtime_ns, st.st_size)
+
+        parsed = self._files.get(f)
+        if parsed is not None and parsed.stat == stat and parsed.data == data:
+            return False
+
+        self._files[f] = _ParsedFile(
+            stat,
+            data,
+            MultiProcessCollector._read_metrics([f]),  # type: ignore[no-untyped-call]
+        )
+
+        return True
+
+
+def _read_used(fh: BinaryIO) -> bytes:
+    """
+    Read the used part of the mmap file *fh*, including the header.
+    """
+    header = fh.read(_USED.size)
+
+    return header + fh.read(_USED.unpack(header)[0] - _USED.size)
+
+
+def _merge(parsed: list[dict[str, Metric]]) -> Iterable[Metric]:
+    """
+    Merge the per-file metrics in *parsed* like prometheus_client does.
+    """
+    metrics: dict[str, Metric] = {}
+    for file_metrics in parsed:
+        for name, metric in file_metrics.items():
+            merged = metrics.get(name)
+            if merged is None:
+                # Never touch the cached metrics: accumulating rewrites the
+                # samples in-place.
+                merged = metrics[name] = Metric(
+                    metric.name, metric.documentation, metric.type
+                )
+                mode = getattr(metric, "_multiprocess_mode", None)
+                if mode is not None:
+                    merged._multiprocess_mode = mode  # type: ignore[attr-defined]
+            merged.samples.extend(metric.samples)
+
+    return list(
+        MultiProcessCollector._accumulate_metrics(metrics, accumulate=True)  # type: ignore[no-untyped-call]
+    )
@@ -0,0 +1,259 @@
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2016 Hynek Schlawack
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+aiohttp client tracing that instruments outgoing requests.
+"""
+
+from __future__ import annotations
+
+from time import perf_counter
+from typing import TYPE_CHECKING
+
+import aiohttp
+
+from prometheus_client import REGISTRY, Histogram
+
+
+if TYPE_CHECKING:
+    from types import SimpleNamespace
+
+    from prometheus_client import CollectorRegistry
+
+
+_OTHER_HOSTS = "other"
+
+
+class _ClientMetrics:
+    """
+    The metrics behind :func:`trace_config` and the trace signal handlers
+    that record them.
+    """
+
+    def __init__(
+        self,
+        registry: CollectorRegistry | None,
+        namespace: str,
+        max_hosts: int,
+    ) -> None:
+        def histogram(
+            name: str, doc: str, labels: tuple[str, ...] = ()
+        ) -> Histogram:
+            return Histogram(
+                f"{namespace}_{name}_seconds",
+                doc,
+                ["host", "method", *labels],
+                registry=registry,
+            )
+
+        self._phases = (
+            histogram("dns_resolution", "Time spent resolving host names."),
+            histogram(
+                "connection_queued",
+                "Time spent waiting for a free connection in the pool.",
+            ),
+            histogram(
+                "connection_create", "Time spent establishing connections."
+            ),
+            histogram(
+                "time_to_first_byte",
+                "Time between sending the request headers and receiving "
+                "the response headers.",
+            ),
+        )
+        self._duration = histogram(
+            "request_duration",
+            "Time between starting a request and receiving the response "
+            "headers or failing.",
+            ("outcome",),
+        )
+        self._max_hosts = max_hosts
+        self._children: dict[tuple[str, str], tuple[Histogram, ...]] = {}
+        self._hosts: set[str] = set()
+
+    def _labelled(self, host: str, method: str) -> tuple[Histogram, ...]:
+        """
+        Return the children for *host* and *method*, lumping all hosts
+        beyond *max_hosts* into one.
+
+        The children are the phases, followed by the request durations of
+        requests that succeeded and that failed.
+        """
+        children = self._children.get((host, method))
+        if children is not None:
+            return children
+
+        if host != _OTHER_HOSTS and host not in self._hosts:
+            if len(self._hosts) >= self._max_hosts:
+                return self._labelled(_OTHER_HOSTS, method)
+            self._hosts.add(host)
+
+        children = self._children[host, method] = (
+            *(m.labels(host, method) for m in self._phases),
+            self._duration.labels(host, method, "ok"),
+            self._duration.labels(host, method, "error"),
+        )
+
+        return children
+
+    async def on_request_start(
+        self,
+        session: aiohttp.ClientSession,
+        ctx: SimpleNamespace,
+        params: aiohttp.TraceRequestStartParams,
+    ) -> None:
+        ctx.start = perf_counter()
+        ctx.children = self._labelled(params.url.host or "", params.method)
+
+    async def on_dns_resolvehost_start(
+        self,
+        session: aiohttp.ClientSession,
+        ctx: SimpleNamespace,
+        params: aiohttp.TraceDnsResolveHostStartParams,
+    ) -> None:
+        ctx.dns_start = perf_counter()
+
+    async def on_dns_resolvehost_end(
+        self,
+        session: aiohttp.ClientSession,
+        ctx: SimpleNamespace,
+        params: aiohttp.TraceDnsResolveHostEndParams,
+    ) -> None:
+        ctx.children[0].observe(perf_counter() - ctx.dns_start)
+
+    async def on_connection_queued_start(
+        self,
+        session: aiohttp.ClientSession,
+        ctx: SimpleNamespace,
+        params: aiohttp.TraceConnectionQueuedStartParams,
+    ) -> None:
+        ctx.queued_start = perf_counter()
+
+    async def on_connection_queued_end(
+        self,
+        session: aiohttp.ClientSession,
+        ctx: SimpleNamespace,
+        params: aiohttp.TraceConnectionQueuedEndParams,
+    ) -> None:
+        ctx.children[1].observe(perf_counter() - ctx.queued_start)
+        ctx.queued_start = None
+
+    async def on_connection_create_start(
+        self,
+        session: aiohttp.ClientSession,
+        ctx: SimpleNamespace,
+        params: aiohttp.TraceConnectionCreateStartParams,
+    ) -> None:
+        ctx.create_start = perf_counter()
+
+    async def on_connection_create_end(
+        self,
+        session: aiohttp.ClientSession,
+        ctx: SimpleNamespace,
+        params: aiohttp.TraceConnectionCreateEndParams,
+    ) -> None:
+        ctx.children[2].observe(perf_counter() - ctx.create_start)
+
+    async def on_request_headers_sent(
+        self,
+        session: aiohttp.ClientSession,
+        ctx: SimpleNamespace,
+        params: aiohttp.TraceRequestHeadersSentParams,
+    ) -> None:
+        ctx.headers_sent = perf_counter()
+
+    async def on_request_end(
+        self,
+        session: aiohttp.ClientSession,
+        ctx: SimpleNamespace,
+        params: aiohttp.TraceRequestEndParams,
+    ) -> None:
+        now = perf_counter()
+        headers_sent = getattr(ctx, "headers_sent", None)
+        if headers_sent is not None:
+            ctx.children[3].observe(now - headers_sent)
+        ctx.children[4].observe(now - ctx.start)
+
+    async def on_request_exception(
+        self,
+        session: aiohttp.ClientSession,
+        ctx: SimpleNamespace,
+        params: aiohttp.TraceRequestExceptionParams,
+    ) -> None:
+        now = perf_counter()
+        # E.g. a timeout while waiting for a free connection.
+        queued_start = getattr(ctx, "queued_start", None)
+        if queued_start is not None:
+            ctx.children[1].observe(now - queued_start)
+        ctx.children[5].observe(now - ctx.start)
+
+
+def trace_config(
+    *,
+    registry: CollectorRegistry | None = REGISTRY,
+    namespace: str = "aiohttp_client",
+    max_hosts: int = 100,
+) -> aiohttp.TraceConfig:
+    """
+    Create an :class:`aiohttp.TraceConfig` that records where the time of
+    outgoing requests goes.
+
+    The following histograms are recorded, labelled by *host* and *method*:
+
+    - ``<namespace>_dns_resolution_seconds``: resolving host names that
+      weren't cached,
+    - ``<namespace>_connection_queued_seconds``: waiting for a free
+      connection in the pool -- if this grows, your connector's limits are
+      exhausted,
+    - ``<namespace>_connection_create_seconds``: establishing new
+      connections, including TLS handshakes,
+    - ``<namespace>_time_to_first_byte_seconds``: from sending the request
+      headers to receiving the response headers,
+    - ``<namespace>_request_duration_seconds``: from starting the request --
+      including redirects -- to receiving the response headers or failing.
+      Reading the response body isn't included.  Additionally labelled by
+      *outcome*: ``ok`` or ``error``.
+
+    If a request fails while waiting for a free connection, the time it
+    waited is recorded, too.
+
+    To keep the number of series bounded, only the first *max_hosts* hosts
+    get their own label; all others are labelled ``other``.
+
+    :param prometheus_client.CollectorRegistry registry: Where to register
+        the metrics.  ``None`` means not to register them at all.
+    :param str namespace: Prefix of the metric names.
+    :param int max_hosts: How many hosts get their own label.
+
+    :returns: A trace config you can pass to :class:`aiohttp.ClientSession`
+        using *trace_configs*.
+
+    .. versionadded:: 26.2.0
+    """
+    metrics = _ClientMetrics(registry, namespace, max_hosts)
+
+    tc = aiohttp.TraceConfig()
+    tc.on_request_start.append(metrics.on_request_start)
+    tc.on_dns_resolvehost_start.append(metrics.on_dns_resolvehost_start)
+    tc.on_dns_resolvehost_end.append(metrics.on_dns_resolvehost_end)
+    tc.on_connection_queued_start.append(metrics.on_connection_queued_start)
+    tc.on_connection_queued_end.append(metrics.on_connection_queued_end)
+    tc.on_connection_create_start.append(metrics.on_connection_create_start)
+    tc.on_connection_create_end.append(metrics.on_connection_create_end)
+    tc.on_request_headers_sent.append(metrics.on_request_headers_sent)
+    tc.on_request_end.append(metrics.on_request_end)
+    tc.on_request_exception.append(metrics.on_request_exception)
+
+    return tc
@@ -123,6 +123,11 @@ class _LocalConsulAgentClient:  # pragma: no cover -- needs local consul client
         tags: list[str] | None,
         metrics_server: MetricsHTTPServer,
     ) -> aiohttp.ClientResponse | None:
+        socket = metrics_server.socket
+        if isinstance(socket, str):
+            msg = "Consul can only check metrics servers that listen on TCP."
+            raise ValueError(msg)
+
         async with self.session_factory() as session:
             resp = await session.put(
                 self.agent_url / "service/register",
@@ -130,8 +135,8 @@ class _LocalConsulAgentClient:  # pragma: no cover -- needs local consul client
                     "Name": name,
                     "ID": service_id,
                     "Tags": tags,
-                    "Address": metrics_server.socket.addr,
-                    "Port": metrics_server.socket.port,
+                    "Address": socket.addr,
+                    "Port": socket.port,
                     "Check": {"HTTP": metrics_server.url, "Interval": "10s"},
                 },
             )
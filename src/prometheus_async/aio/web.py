@@ -24,54 +24,432 @@ import asyncio
 import queue
 import threading
 
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
+from functools import partial
+from time import perf_counter
 from typing import TYPE_CHECKING, NamedTuple
+from urllib.parse import quote
 
 from aiohttp import web
-from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+)
 from prometheus_client.openmetrics import exposition as openmetrics
 
+from .._negotiation import _choose_generator
+from ._exposition import (
+    ENCODERS,
+    _count_series,
+    _OverloadedError,
+    _register,
+    _Renderer,
+    _unregister,
+)
+from ._multiprocess import _CachedMultiProcessCollector
+
 
 if TYPE_CHECKING:
     import ssl
 
-    from typing import Callable
+    from collections.abc import AsyncIterator, Iterable, Sequence
+    from concurrent.futures import Executor
+
+    from prometheus_client.registry import Collector
 
     from ..types import Deregisterer, ServiceDiscovery
 
 
-def _choose_generator(accept_header: str | None) -> tuple[Callable, str]:
+def _choose_encoding(
+    accept_encoding_header: str | None, encodings: Iterable[str] = ENCODERS
+) -> str | None:
+    """
+    Return the most preferred of *encodings* according to
+    *accept_encoding_header*.
+
+    Return ``None`` if the body should be sent as-is.
+    """
+    qualities = {}
+    for accepted in (accept_encoding_header or "").split(","):
+        coding, *params = accepted.split(";")
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[coding.strip().lower()] = q
+
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = qualities.get(encoding, qualities.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+
+    return best
+
+
+# Seconds to subtract from Prometheus's scrape timeout to leave room for
+# transmitting the response.
+_SCRAPE_TIMEOUT_OFFSET = 0.5
+
+
+def _scrape_timeout(header: str | None) -> float | None:
+    """
+    Return how many seconds we have to render according to the scraper's
+    *header*.
+    """
+    if header is None:
+        return None
+
+    try:
+        timeout = float(header)
+    except ValueError:
+        return None
+
+    if timeout <= 0:
+        return None
+
+    if timeout > _SCRAPE_TIMEOUT_OFFSET * 2:
+        return timeout - _SCRAPE_TIMEOUT_OFFSET
+
+    return timeout / 2
+
+
+def _format(request: web.Request) -> str:
+    """
+    Return the name of the exposition format *request* asks for, for use as
+    a metric label.
+    """
+    generate, _ = _choose_generator(request.headers.get("Accept"))
+
+    return "openmetrics" if generate is openmetrics.generate_latest else "text"
+
+
+def _selection(request: web.Request) -> tuple[list[str], list[str]]:
+    """
+    Return the metric names and name prefixes *request* asks for using the
+    ``name[]`` and ``prefix[]`` query parameters.
+    """
+    # server_stats() has always only needed the headers of its request.
+    query = getattr(request, "query", None)
+    if not query:
+        return [], []
+
+    return query.getall("name[]", []), query.getall("prefix[]", [])
+
+
+# Seconds overloaded scrapers are asked to wait before retrying.
+_RETRY_AFTER = "1"
+
+
+def _etag_matches(etag: str, if_none_match_header: str | None) -> bool:
+    """
+    Does *etag* match any of the entity tags in *if_none_match_header*?
+
+    As mandated for If-None-Match, the weak comparison is used.
+    """
+    if not if_none_match_header:
+        return False
+
+    for tag in if_none_match_header.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+
+    return False
+
+
+class _ScrapeMetrics:
     """
-    Return the correct generate function according to *accept_header*.
+    The metrics about the scrapes of a metrics endpoint.
+    """
+
+    def __init__(self) -> None:
+        self.duration = Histogram(
+            "prometheus_async_scrape_duration_seconds",
+            "Time spent answering scrapes.",
+            ["format"],
+            registry=None,
+        )
+        self.size = Histogram(
+            "prometheus_async_scrape_size_bytes",
+            "Size of the served expositions before compression.",
+            ["format"],
+            buckets=[1024 * 4**i for i in range(10)],
+            registry=None,
+        )
+        self.series = Gauge(
+            "prometheus_async_scrape_series",
+            "Number of series in the latest served exposition.",
+            ["format"],
+            registry=None,
+        )
+        self.failures = Counter(
+            "prometheus_async_scrape_failures",
+            "Scrapes that failed because rendering raised an exception.",
+            ["format"],
+            registry=None,
+        )
+        self.in_progress = Gauge(
+            "prometheus_async_scrapes_in_progress",
+            "Scrapes that are currently being answered.",
+            ["format"],
+            registry=None,
+            multiprocess_mode="livesum",
+        )
+        self.metrics: list[Collector] = [
+            self.duration,
+            self.size,
+            self.series,
+            self.failures,
+            self.in_progress,
+        ]
+
+    def observe(self, fmt: str, size: int, series: int) -> None:
+        """
+        Record the *size* and number of *series* of a served exposition in
+        *fmt*.
+        """
+        self.size.labels(fmt).observe(size)
+        self.series.labels(fmt).set(series)
+
+
+class _MetricsView:
+    """
+    The metrics endpoint, rendering through *renderer*.
 
-    Default to the old style.
+    If *compress* is True, bodies of at least *compress_min_size* bytes are
+    compressed at *compress_level* if the client accepts it.
+
+    If *etag* is True, responses carry an ETag and conditional requests are
+    answered with 304 if the exposition hasn't changed.
+
+    If *stream* is True, the exposition is streamed family by family instead.
+
+    If *instrument* is True, scrapes are measured using the scrape metrics in
+    :attr:`metrics`.  Each view has its own and creates them only if
+    instrumented, the caller is expected to register them.
     """
-    accept_header = accept_header or ""
-    for accepted in accept_header.split(","):
-        if accepted.split(";")[0].strip() == "application/openmetrics-text":
-            return (
-                openmetrics.generate_latest,
-                openmetrics.CONTENT_TYPE_LATEST,
+
+    def __init__(
+        self,
+        renderer: _Renderer,
+        *,
+        compress: bool = False,
+        compress_min_size: int = 1024,
+        compress_level: int | None = None,
+        etag: bool = False,
+        stream: bool = False,
+        instrument: bool = False,
+    ) -> None:
+        self._renderer = renderer
+        self._etag = etag
+        self._compress = compress
+        self._compress_min_size = compress_min_size
+        self._compress_level = compress_level
+        self._stream = stream
+
+        self._scrape: _ScrapeMetrics | None = None
+        self.metrics: list[Collector] = []
+        if instrument:
+            self._scrape = _ScrapeMetrics()
+            self.metrics += self._scrape.metrics
+
+    async def __call__(self, request: web.Request) -> web.StreamResponse:
+        scrape = self._scrape
+        if scrape is None:
+            return await self._dispatch(request)
+
+        fmt = _format(request)
+        in_progress = scrape.in_progress.labels(fmt)
+        in_progress.inc()
+        start = perf_counter()
+        try:
+            return await self._dispatch(request)
+        except Exception:
+            scrape.failures.labels(fmt).inc()
+            raise
+        finally:
+            in_progress.dec()
+            scrape.duration.labels(fmt).observe(perf_counter() - start)
+
+    async def _dispatch(self, request: web.Request) -> web.StreamResponse:
+        if self._stream:
+            return await self.stream(request)
+
+        return await self.respond(request)
+
+    @staticmethod
+    def _overloaded() -> web.Response:
+        return web.Response(
+            status=503,
+            headers={"Retry-After": _RETRY_AFTER},
+            text="Too many concurrent scrapes.",
+        )
+
+    async def stream(self, request: web.Request) -> web.StreamResponse:
+        """
+        Stream the exposition using chunked transfer encoding.
+
+        Compression is delegated to aiohttp and therefore only gzip.
+        """
+        generate, content_type = _choose_generator(
+            request.headers.get("Accept")
+        )
+
+        rsp = web.StreamResponse()
+        rsp.content_type = content_type
+        rsp.enable_chunked_encoding()
+        if self._compress:
+            rsp.headers["Vary"] = "Accept-Encoding"
+            if _choose_encoding(
+                request.headers.get("Accept-Encoding"), ("gzip",)
+            ):
+                rsp.enable_compression(web.ContentCoding.gzip)
+
+        size = series = 0
+        try:
+            async with self._renderer.slot():
+                await rsp.prepare(request)
+                async for chunk in self._renderer.stream(
+                    generate, *_selection(request)
+                ):
+                    await rsp.write(chunk)
+                    if self._scrape is not None:
+                        size += len(chunk)
+                        series += _count_series(chunk)
+        except _OverloadedError:
+            return self._overloaded()
+
+        if self._scrape is not None:
+            self._scrape.observe(_format(request), size, series)
+
+        await rsp.write_eof()
+
+        return rsp
+
+    async def respond(self, request: web.Request) -> web.Response:
+        """
+        Render the exposition and return it in one response.
+        """
+        generate, content_type = _choose_generator(
+            request.headers.get("Accept")
+        )
+
+        names, prefixes = _selection(request)
+        try:
+            if names or prefixes:
+                snapshot = await self._renderer.render_restricted(
+                    generate, names, prefixes
+                )
+            else:
+                snapshot = await self._renderer.render(
+                    generate,
+                    _scrape_timeout(
+                        request.headers.get(
+                            "X-Prometheus-Scrape-Timeout-Seconds"
+                        )
+                    ),
+                )
+        except _OverloadedError:
+            return self._overloaded()
+
+        body = snapshot.body
+        headers = {}
+
+        if self._scrape is not None:
+            self._scrape.observe(
+                _format(request), len(body), _count_series(body)
+            )
+
+        encoding = None
+        if self._compress:
+            headers["Vary"] = "Accept-Encoding"
+            if len(body) >= self._compress_min_size:
+                encoding = _choose_encoding(
+                    request.headers.get("Accept-Encoding")
+                )
+
+        if self._etag:
+            digest = await self._renderer.digest(snapshot)
+            etag = headers["ETag"] = (
+                f'"{digest}"' if encoding is None else f'"{digest}-{encoding}"'
+            )
+            if _etag_matches(etag, request.headers.get("If-None-Match")):
+                return web.Response(status=304, headers=headers)
+
+        if encoding is not None:
+            body = await self._renderer.encode(
+                snapshot, encoding, self._compress_level
             )
+            headers["Content-Encoding"] = encoding
+
+        rsp = web.Response(body=body, headers=headers)
+        # This is set separately because aiohttp complains about `;` in
+        # content_type thinking it means there's also a charset.
+        # cf. https://github.com/aio-libs/aiohttp/issues/2197
+        rsp.content_type = content_type
 
-    return generate_latest, CONTENT_TYPE_LATEST
+        return rsp
+
+
+_SERVER_STATS = _MetricsView(_Renderer(REGISTRY))
 
 
 async def server_stats(request: web.Request) -> web.Response:
     """
     Return a web response with the plain text version of the metrics.
 
+    Concurrent requests for the same format share a single render.
+
+    Pass one or more ``name[]`` query parameters to only get the metrics with
+    these names, and ``prefix[]`` to get the metrics whose names start with
+    them.  Collectors that can't contribute aren't collected at all.
+
     :rtype: :class:`aiohttp.web.Response`
+
+    .. versionchanged:: 26.2.0
+       Concurrent renders of the same format are coalesced.
+    .. versionchanged:: 26.2.0
+       The ``name[]`` and ``prefix[]`` query parameters.
     """
-    generate, content_type = _choose_generator(request.headers.get("Accept"))
+    return await _SERVER_STATS.respond(request)
 
-    rsp = web.Response(body=generate(REGISTRY))
-    # This is set separately because aiohttp complains about `;` in
-    # content_type thinking it means there's also a charset.
-    # cf. https://github.com/aio-libs/aiohttp/issues/2197
-    rsp.content_type = content_type
 
-    return rsp
+async def _collector_timings(
+    renderers: Mapping[str, _Renderer], request: web.Request
+) -> web.Response:
+    """
+    Report the time spent in each collector during the latest instrumented
+    render of the registry served at the *path* query parameter, slowest
+    first.
+    """
+    renderer = renderers.get(request.query.get("path", "/metrics"))
+    if renderer is None:
+        raise web.HTTPNotFound
+
+    latest = renderer.timings.latest if renderer.timings is not None else {}
+
+    return web.json_response(
+        [
+            {
+                "collector": name,
+                "collect_seconds": collect,
+                "encode_seconds": encode,
+            }
+            for name, (collect, encode) in sorted(
+                latest.items(), key=lambda item: -sum(item[1])
+            )
+        ]
+    )
 
 
 _REF = '<html><body><a href="/metrics">Metrics</a></body></html>'
@@ -86,23 +464,276 @@ async def _cheap(request: web.Request) -> web.Response:
     return web.Response(text=_REF, content_type="text/html")
 
 
+def add_metrics_routes(
+    app: web.Application,
+    *,
+    registry: CollectorRegistry | Mapping[str, CollectorRegistry] = REGISTRY,
+    render_in_thread: bool = False,
+    executor: Executor | None = None,
+    compress: bool = False,
+    compress_min_size: int = 1024,
+    compress_level: int | None = None,
+    stream: bool = False,
+    prerender_interval: float | None = None,
+    max_staleness: float | None = None,
+    etag: bool = False,
+    collector_timing: bool = False,
+    max_concurrent_renders: int | None = None,
+    max_queued_scrapes: int = 0,
+    multiprocess: bool = False,
+    instrument: bool = False,
+) -> None:
+    """
+    Add the metrics endpoints to your own *app*, including all features of
+    :func:`start_http_server`'s metrics endpoints.
+
+    Background work like pre-rendering is tied to *app*'s lifecycle, so you
+    have to call this before *app* starts.  To mount the metrics under a
+    prefix, add them to a fresh application and add that using
+    :meth:`aiohttp.web.Application.add_subapp`.
+
+    For arguments see :func:`start_http_server`.
+
+    :raises ValueError: If *max_concurrent_renders* is less than 1, if
+        *etag* and *stream* are both True, or if *multiprocess* is True and
+        ``PROMETHEUS_MULTIPROC_DIR`` is not a directory or *registry* is
+        passed.
+
+    .. versionadded:: 26.2.0
+    """
+    if max_concurrent_renders is not None and max_concurrent_renders < 1:
+        msg = "max_concurrent_renders must be at least 1."
+        raise ValueError(msg)
+
+    if etag and stream:
+        msg = "etag can't be combined with stream."
+        raise ValueError(msg)
+
+    if multiprocess:
+        if registry is not REGISTRY:
+            msg = "multiprocess can't be combined with registry."
+            raise ValueError(msg)
+
+        registry = CollectorRegistry()
+        registry.register(_CachedMultiProcessCollector())
+
+    registries = (
+        registry if isinstance(registry, Mapping) else {"/metrics": registry}
+    )
+    renderers = {}
+    for route, reg in registries.items():
+        renderer = _Renderer(
+            reg,
+            executor=_own_executor(app)
+            if executor is None and render_in_thread
+            else executor,
+            prerender_interval=prerender_interval,
+            max_staleness=max_staleness,
+            collector_timing=collector_timing,
+            max_concurrent_renders=max_concurrent_renders,
+            max_queued_scrapes=max_queued_scrapes,
+            keep_latest=compress or etag,
+        )
+        view = _MetricsView(
+            renderer,
+            compress=compress,
+            compress_min_size=compress_min_size,
+            compress_level=compress_level,
+            etag=etag,
+            stream=stream,
+            instrument=instrument,
+        )
+        # In multiprocess mode, our metrics are written to
+        # PROMETHEUS_MULTIPROC_DIR and collected from there like all others
+        # -- except for the collector timings that only this process has.
+        metrics: list[Collector] = (
+            [m for m in renderer.metrics if m is renderer.timings]
+            if multiprocess
+            else [*renderer.metrics, *view.metrics]
+        )
+        app.cleanup_ctx.append(partial(_run_renderer, renderer, reg, metrics))
+        app.router.add_get(route, view)
+        renderers[route] = renderer
+
+    if collector_timing:
+        app.router.add_get(
+            "/debug/collectors", partial(_collector_timings, renderers)
+        )
+
+
 async def start_http_server(
     *,
-    addr: str = "",
+    addr: str | Sequence[str] = "",
     port: int = 0,
     ssl_ctx: ssl.SSLContext | None = None,
     service_discovery: ServiceDiscovery | None = None,
+    registry: CollectorRegistry | Mapping[str, CollectorRegistry] = REGISTRY,
+    render_in_thread: bool = False,
+    executor: Executor | None = None,
+    compress: bool = False,
+    compress_min_size: int = 1024,
+    compress_level: int | None = None,
+    stream: bool = False,
+    prerender_interval: float | None = None,
+    max_staleness: float | None = None,
+    etag: bool = False,
+    collector_timing: bool = False,
+    max_concurrent_renders: int | None = None,
+    max_queued_scrapes: int = 0,
+    multiprocess: bool = False,
+    instrument: bool = False,
+    reuse_port: bool = False,
+    unix_path: str | None = None,
 ) -> MetricsHTTPServer:
     """
     Start an HTTP(S) server on *addr*:*port*.
 
     If *ssl_ctx* is set, use TLS.
 
-    :param str addr: Interface to listen on. Leaving empty will listen on all
-        interfaces.
+    By default, the metrics are rendered on the event loop which blocks it for
+    the duration of the render.  If that's a problem for you -- e.g. because
+    your registries are large --, pass *render_in_thread* or *executor* to
+    render them off the loop.  In that case, the time spent rendering and
+    waiting for a free worker are recorded in the
+    ``prometheus_async_render_duration_seconds`` and
+    ``prometheus_async_render_queued_seconds`` histograms.
+
+    Additionally, off-loop rendering honors the scrape timeout that Prometheus
+    sends in the ``X-Prometheus-Scrape-Timeout-Seconds`` header: if a render
+    doesn't finish in time, the scrape is answered using the previous render.
+    If there is none, the scrape is answered with what has been rendered so
+    far, followed by a ``prometheus_async_scrape_truncated`` metric.  Such
+    scrapes are counted in the ``prometheus_async_scrape_deadline_exceeded``
+    counter.
+
+    If *compress* is True, responses are compressed using zstd or gzip --
+    depending on the scraper's ``Accept-Encoding`` header.  zstd is only
+    available on Python 3.14 and later, or if the *zstandard* package is
+    installed.  Compressed bodies are cached together with the rendered ones,
+    so identical renders are never compressed twice.
+
+    If *stream* is True, the metrics are streamed to the scraper one metric
+    family at a time using chunked transfer encoding.  That way, the memory
+    needed for a scrape depends on the largest family and not on the size of
+    the whole registry.  Streamed scrapes are neither coalesced nor cached,
+    and are only compressed using gzip.
+
+    If *prerender_interval* is set, the metrics are rendered in the background
+    every *prerender_interval* seconds and scrapes are answered using the
+    latest render.  That makes the scrape latency independent of the size of
+    your registries.  Each format (text and OpenMetrics) is pre-rendered once
+    it has been requested for the first time.  If the latest render is older
+    than *max_staleness* seconds, the scrape forces a fresh render.
+
+    If *etag* is True, responses carry an ``ETag`` header based on a hash of
+    the rendered metrics, and requests whose ``If-None-Match`` header matches
+    are answered with an empty ``304 Not Modified``.  The hash is cached
+    together with the render, so in combination with *prerender_interval*,
+    scrapes of an unchanged registry cost neither a render nor bandwidth.
+    Streamed responses don't know their hash up-front, so *etag* can't be
+    combined with *stream*.
+
+    If *collector_timing* is True, the time each collector takes to collect
+    and encode its metrics is measured on every render.  The durations of the
+    latest render are exposed in the
+    ``prometheus_async_collector_duration_seconds`` gauge, and as JSON --
+    slowest first -- under ``/debug/collectors``.  This makes rendering
+    slightly slower, so you should only enable it while hunting down
+    expensive collectors.
+
+    By default, the global :data:`prometheus_client.REGISTRY` is served at
+    ``/metrics``.  Pass a different registry using *registry*, or a mapping
+    of paths to registries to serve several registries at once -- for
+    example, to let Prometheus scrape expensive collectors less often than
+    cheap ones.  Every registry gets its own render cache, render slots, and
+    -- if *render_in_thread* is True -- render thread, so slow registries
+    don't hold up fast ones.
+
+    Like :func:`server_stats`, the metrics endpoints support restricting the
+    metrics using the ``name[]`` and ``prefix[]`` query parameters.
+
+    If *multiprocess* is True, the metrics of all processes in
+    ``PROMETHEUS_MULTIPROC_DIR`` are aggregated like
+    :class:`prometheus_client.multiprocess.MultiProcessCollector` does --
+    for example, if your application runs in multiple Gunicorn workers.  The
+    parsed files are cached and only files that changed since the previous
+    scrape are parsed again.  *registry* can't be combined with
+    *multiprocess*.
+
+    If *instrument* is True, the cost of the metrics endpoints themselves is
+    exposed, labelled by the exposition format: scrape durations in
+    ``prometheus_async_scrape_duration_seconds``, the uncompressed size of
+    the served expositions in ``prometheus_async_scrape_size_bytes``, the
+    number of series served by the latest scrape in
+    ``prometheus_async_scrape_series``, failed renders in
+    ``prometheus_async_scrape_failures_total``, and concurrent scrapes in
+    ``prometheus_async_scrapes_in_progress``.  If *registry* is a mapping,
+    each path exposes the metrics about its own scrapes and renders.
+
+    If *reuse_port* is True, multiple processes can listen on the same port
+    and the kernel spreads the scrapes among them.  Combined with
+    *multiprocess*, every worker of a pre-forking server can serve the
+    metrics of all of them, without a port per worker.  Not all platforms
+    support ``SO_REUSEPORT``.
+
+    If *unix_path* is passed, the server listens on a Unix domain socket at
+    that path -- for example, for a scraping sidecar on the same host.  In
+    that case, it only listens on TCP, too, if *addr* or *port* are passed
+    explicitly.
+
+    If *max_concurrent_renders* is set, at most that many renders run at the
+    same time and at most *max_queued_scrapes* further scrapes wait for one
+    to finish.  Excess scrapes are rejected with a ``503 Service
+    Unavailable`` and a ``Retry-After`` header.  Scrapes that can join a
+    render of the same format that is already running are never rejected.
+    Queued and rejected scrapes are counted in the
+    ``prometheus_async_scrapes_queued`` and
+    ``prometheus_async_scrapes_rejected`` counters.
+
+    :param addr: Interface to listen on. Leaving empty will listen on all
+        interfaces.  Pass a list to listen on several interfaces -- for
+        example, on both IPv4 and IPv6.
+    :type addr: str | ~collections.abc.Sequence[str]
     :param int port: Port to listen on.
     :param ssl.SSLContext ssl_ctx: TLS settings
     :param service_discovery: see :ref:`sd`
+    :param registry: The registry to serve, or a mapping of paths to
+        registries.
+    :type registry: prometheus_client.CollectorRegistry | ~typing.Mapping
+    :param bool render_in_thread: Render the metrics in a dedicated worker
+        thread that is shut down together with the server.
+    :param concurrent.futures.Executor executor: Render the metrics using
+        this executor.  You are responsible for shutting it down.  It is
+        shared by all registries.
+    :param bool compress: Compress responses if the client supports it.
+    :param int compress_min_size: Don't compress bodies smaller than this
+        many bytes.
+    :param int compress_level: Compression level passed to the encoder.
+        ``None`` means the encoder's default.
+    :param bool stream: Stream the metrics instead of rendering them at once.
+    :param float prerender_interval: Pre-render the metrics every this many
+        seconds.
+    :param float max_staleness: Never serve pre-rendered metrics that are
+        older than this many seconds.  ``None`` means no limit.
+    :param bool etag: Support conditional requests using ETags.
+    :param bool collector_timing: Measure the time spent in each collector.
+        The timings of registries that aren't served at ``/metrics`` are
+        available using the *path* query parameter.
+    :param int max_concurrent_renders: Limit the number of concurrent renders.
+        ``None`` means no limit.
+    :param int max_queued_scrapes: How many scrapes may wait for a render
+        slot.
+    :param bool multiprocess: Serve the aggregated metrics of all processes
+        using ``prometheus_client``'s multiprocess mode.
+    :param bool instrument: Expose metrics about the metrics endpoints
+        themselves.
+    :param bool reuse_port: Set ``SO_REUSEPORT`` on the listening socket.
+    :param str unix_path: Listen on a Unix domain socket at this path.
+
+    :raises ValueError: If *max_concurrent_renders* is less than 1, if
+        *etag* and *stream* are both True, or if *multiprocess* is True and
+        ``PROMETHEUS_MULTIPROC_DIR`` is not a directory or *registry* is
+        passed.
 
     :rtype: MetricsHTTPServer
 
@@ -111,15 +742,67 @@ async def start_http_server(
        The *loop* argument is a no-op now and will be removed in one year by
        the earliest.
     .. versionchanged:: 21.1.0 The *loop* argument has been removed.
+    .. versionadded:: 26.2.0 *render_in_thread* and *executor*
+    .. versionadded:: 26.2.0
+       *compress*, *compress_min_size*, and *compress_level*
+    .. versionadded:: 26.2.0 *stream*
+    .. versionadded:: 26.2.0 *prerender_interval* and *max_staleness*
+    .. versionadded:: 26.2.0 *etag*
+    .. versionadded:: 26.2.0 *collector_timing*
+    .. versionadded:: 26.2.0 *max_concurrent_renders* and *max_queued_scrapes*
+    .. versionadded:: 26.2.0 *registry*
+    .. versionadded:: 26.2.0 *multiprocess*
+    .. versionadded:: 26.2.0 *instrument*
+    .. versionadded:: 26.2.0 *reuse_port*
+    .. versionadded:: 26.2.0 *unix_path*
+    .. versionchanged:: 26.2.0 *addr* can be a list of addresses.
     """
+    addrs: Sequence[str] = [addr] if isinstance(addr, str) else addr
+    if unix_path is not None and not (addr or port):
+        addrs = []
+    if not addrs and unix_path is None:
+        msg = "Nothing to listen on."
+        raise ValueError(msg)
+
     app = web.Application()
+    add_metrics_routes(
+        app,
+        registry=registry,
+        render_in_thread=render_in_thread,
+        executor=executor,
+        compress=compress,
+        compress_min_size=compress_min_size,
+        compress_level=compress_level,
+        stream=stream,
+        prerender_interval=prerender_interval,
+        max_staleness=max_staleness,
+        etag=etag,
+        collector_timing=collector_timing,
+        max_concurrent_renders=max_concurrent_renders,
+        max_queued_scrapes=max_queued_scrapes,
+        multiprocess=multiprocess,
+        instrument=instrument,
+    )
     app.router.add_get("/", _cheap)
-    app.router.add_get("/metrics", server_stats)
 
     runner = web.AppRunner(app, access_log=None)
     await runner.setup()
-    site = web.TCPSite(runner, addr, port, ssl_context=ssl_ctx)
-    await site.start()
+    sites: list[web.BaseSite] = [
+        web.TCPSite(
+            runner, a, port, ssl_context=ssl_ctx, reuse_port=reuse_port
+        )
+        for a in addrs
+    ]
+    if unix_path is not None:
+        sites.append(web.UnixSite(runner, unix_path, ssl_context=ssl_ctx))
+    try:
+        for site in sites:
+            await site.start()
+    except Exception:
+        # Don't leave the sites that did start behind.
+        with suppress(Exception):
+            await runner.cleanup()
+        raise
 
     ms = MetricsHTTPServer.from_server(
         runner=runner, app=app, https=ssl_ctx is not None
@@ -136,6 +819,39 @@ async def start_http_server(
     return ms
 
 
+async def _run_renderer(
+    renderer: _Renderer,
+    registry: CollectorRegistry,
+    metrics: list[Collector],
+    app: web.Application,
+) -> AsyncIterator[None]:
+    """
+    Expose *metrics* through *registry* and run *renderer*'s background work
+    while *app* is running.
+    """
+    _register(registry, *metrics)
+    await renderer.start()
+    yield
+    await renderer.close()
+    _unregister(registry, *metrics)
+
+
+def _own_executor(app: web.Application) -> Executor:
+    """
+    Create a render executor that is shut down together with *app*.
+    """
+    executor = ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="PrometheusAsyncRender"
+    )
+
+    async def shutdown(app: web.Application) -> None:
+        executor.shutdown(wait=False)
+
+    app.on_cleanup.append(shutdown)
+
+    return executor
+
+
 class MetricsHTTPServer:
     """
     A stoppable metrics HTTP server.
@@ -144,14 +860,20 @@ class MetricsHTTPServer:
 
     :ivar socket: Socket the server is listening on.  namedtuple of
         either (:class:`ipaddress.IPv4Address`, port) or
-        (:class:`ipaddress.IPv6Address`, port).
+        (:class:`ipaddress.IPv6Address`, port) -- or the path of the Unix
+        domain socket if the server doesn't listen on TCP.
+    :ivar list sockets: All sockets the server is listening on, in the same
+        format as *socket*.
     :ivar bool https: Whether the server uses SSL/TLS.
     :ivar str url: A valid URL to the metrics endpoint.
     :ivar bool is_registered: Is the web endpoint registered with a
         service discovery system?
+
+    .. versionadded:: 26.2.0 *sockets*
     """
 
-    socket: Socket
+    socket: Socket | str
+    sockets: list[Socket | str]
     https: bool
     _runner: web.AppRunner
     _app: web.Application
@@ -159,27 +881,34 @@ class MetricsHTTPServer:
 
     def __init__(
         self,
-        socket: Socket,
+        socket: Socket | str,
         runner: web.AppRunner,
         app: web.Application,
         https: bool,
+        sockets: list[Socket | str] | None = None,
     ):
         self._app = app
         self._runner = runner
         self._deregister = None
 
         self.socket = socket
+        self.sockets = sockets if sockets is not None else [socket]
         self.https = https
 
     @classmethod
     def from_server(
         cls, runner: web.AppRunner, app: web.Application, https: bool
     ) -> MetricsHTTPServer:
+        sockets = [
+            address if isinstance(address, str) else Socket(*address[:2])
+            for address in runner.addresses
+        ]
         return cls(
-            socket=Socket(*runner.addresses[0][:2]),
+            socket=sockets[0],
             runner=runner,
             app=app,
             https=https,
+            sockets=sockets,
         )
 
     @property
@@ -191,6 +920,12 @@ class MetricsHTTPServer:
 
     @property
     def url(self) -> str:
+        if isinstance(self.socket, str):
+            return "http{s}+unix://{path}/".format(
+                s="s" if self.https else "",
+                path=quote(self.socket, safe=""),
+            )
+
         addr = self.socket.addr
         return "http{s}://{host}:{port}/".format(
             s="s" if self.https else "",
@@ -220,11 +955,15 @@ class ThreadedMetricsHTTPServer:
     yourself.
 
     :ivar socket: Socket the server is listening on.  namedtuple of
-        ``Socket(addr, port)``.
+        ``Socket(addr, port)`` or the path of the Unix domain socket if the
+        server doesn't listen on TCP.
+    :ivar list sockets: All sockets the server is listening on.
     :ivar bool https: Whether the server uses SSL/TLS.
     :ivar str url: A valid URL to the metrics endpoint.
     :ivar bool is_registered: Is the web endpoint registered with a
         service discovery system?
+
+    .. versionadded:: 26.2.0 *sockets*
     """
 
     def __init__(
@@ -251,9 +990,13 @@ class ThreadedMetricsHTTPServer:
         return self._http_server.https
 
     @property
-    def socket(self) -> Socket:
+    def socket(self) -> Socket | str:
         return self._http_server.socket
 
+    @property
+    def sockets(self) -> list[Socket | str]:
+        return self._http_server.sockets
+
     @property
     def url(self) -> str:
         return self._http_server.url
@@ -266,32 +1009,89 @@ class ThreadedMetricsHTTPServer:
 def start_http_server_in_thread(
     *,
     port: int = 0,
-    addr: str = "",
+    addr: str | Sequence[str] = "",
     ssl_ctx: ssl.SSLContext | None = None,
     service_discovery: ServiceDiscovery | None = None,
+    registry: CollectorRegistry | Mapping[str, CollectorRegistry] = REGISTRY,
+    render_in_thread: bool = False,
+    executor: Executor | None = None,
+    compress: bool = False,
+    compress_min_size: int = 1024,
+    compress_level: int | None = None,
+    stream: bool = False,
+    prerender_interval: float | None = None,
+    max_staleness: float | None = None,
+    etag: bool = False,
+    collector_timing: bool = False,
+    max_concurrent_renders: int | None = None,
+    max_queued_scrapes: int = 0,
+    multiprocess: bool = False,
+    instrument: bool = False,
+    reuse_port: bool = False,
+    unix_path: str | None = None,
 ) -> ThreadedMetricsHTTPServer:
     """
     Start an asyncio HTTP(S) server in a new thread with an own event loop.
 
     Ideal to expose your metrics in non-asyncio Python 3 applications.
 
-    For arguments see :func:`start_http_server`.
+    For arguments see :func:`start_http_server`.  If the server fails to
+    start, the error is raised here.
 
     :rtype: ThreadedMetricsHTTPServer
+
+    .. versionadded:: 26.2.0 *render_in_thread* and *executor*
+    .. versionadded:: 26.2.0
+       *compress*, *compress_min_size*, and *compress_level*
+    .. versionadded:: 26.2.0 *stream*
+    .. versionadded:: 26.2.0 *prerender_interval* and *max_staleness*
+    .. versionadded:: 26.2.0 *etag*
+    .. versionadded:: 26.2.0 *collector_timing*
+    .. versionadded:: 26.2.0 *max_concurrent_renders* and *max_queued_scrapes*
+    .. versionadded:: 26.2.0 *registry*
+    .. versionadded:: 26.2.0 *multiprocess*
+    .. versionadded:: 26.2.0 *instrument*
+    .. versionadded:: 26.2.0 *reuse_port*
+    .. versionadded:: 26.2.0 *unix_path*
+    .. versionchanged:: 26.2.0 *addr* can be a list of addresses.
     """
     q: queue.Queue = queue.Queue()
     loop = asyncio.new_event_loop()
 
     def server() -> None:
         asyncio.set_event_loop(loop)
-        http = loop.run_until_complete(
-            start_http_server(
-                port=port,
-                addr=addr,
-                ssl_ctx=ssl_ctx,
-                service_discovery=service_discovery,
+        try:
+            http = loop.run_until_complete(
+                start_http_server(
+                    port=port,
+                    addr=addr,
+                    ssl_ctx=ssl_ctx,
+                    service_discovery=service_discovery,
+                    registry=registry,
+                    render_in_thread=render_in_thread,
+                    executor=executor,
+                    compress=compress,
+                    compress_min_size=compress_min_size,
+                    compress_level=compress_level,
+                    stream=stream,
+                    prerender_interval=prerender_interval,
+                    max_staleness=max_staleness,
+                    etag=etag,
+                    collector_timing=collector_timing,
+                    max_concurrent_renders=max_concurrent_renders,
+                    max_queued_scrapes=max_queued_scrapes,
+                    multiprocess=multiprocess,
+                    instrument=instrument,
+                    reuse_port=reuse_port,
+                    unix_path=unix_path,
+                )
             )
-        )
+        except Exception as e:  # noqa: BLE001
+            # Hand the error to the caller who's waiting for the server.
+            q.put(e)
+            loop.close()
+            return
+
         q.put(http)
         loop.run_forever()
         loop.run_until_complete(http.close())
@@ -301,4 +1101,9 @@ def start_http_server_in_thread(
     )
     t.start()
 
-    return ThreadedMetricsHTTPServer(q.get(), t, loop)
+    http = q.get()
+    if isinstance(http, Exception):
+        t.join()
+        raise http
+
+    return ThreadedMetricsHTTPServer(http, t, loop)
@@ -18,7 +18,16 @@
 Twisted-related functionality.
 """
 
+from . import web
 from ._decorators import count_exceptions, time, track_inprogress
+from ._reactor import ReactorMonitor, start_reactor_monitor
 
 
-__all__ = ["count_exceptions", "time", "track_inprogress"]
+__all__ = [
+    "ReactorMonitor",
+    "count_exceptions",
+    "start_reactor_monitor",
+    "time",
+    "track_inprogress",
+    "web",
+]
@@ -0,0 +1,206 @@
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2016 Hynek Schlawack
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Reactor health monitoring.
+"""
+
+from __future__ import annotations
+
+from itertools import chain
+from typing import TYPE_CHECKING
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from twisted.internet.task import LoopingCall
+
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+    from typing import Any
+
+    from prometheus_client import CollectorRegistry
+    from prometheus_client.metrics_core import Metric
+
+
+_LAG_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class ReactorMonitor:
+    """
+    A running reactor monitor.
+
+    Returned by :func:`start_reactor_monitor`.  Do *not* instantiate it
+    yourself.
+
+    It's a collector, registered with the registry passed to
+    :func:`start_reactor_monitor`.
+
+    .. versionadded:: 26.2.0
+    """
+
+    def __init__(
+        self,
+        reactor: Any,
+        interval: float,
+        late_threshold: float,
+        registry: CollectorRegistry | None,
+    ) -> None:
+        self._reactor = reactor
+        self._interval = interval
+        self._late_threshold = late_threshold
+        self._registry = registry
+        self._pool = reactor.getThreadPool()
+
+        self._lag = Histogram(
+            "twisted_reactor_lag_seconds",
+            "How late the reactor ran a heartbeat call.",
+            buckets=_LAG_BUCKETS,
+            registry=None,
+        )
+        self._late = Counter(
+            "twisted_reactor_late_heartbeats",
+            "Heartbeats that ran later than the late threshold.",
+            registry=None,
+        )
+        self._queued = Gauge(
+            "twisted_threadpool_queued_calls",
+            "Calls waiting for a worker of the reactor's thread pool.",
+            registry=None,
+        )
+        self._queued.set_function(self._pool.q.qsize)
+        self._busy = Gauge(
+            "twisted_threadpool_busy_workers",
+            "Workers of the reactor's thread pool that are running a call.",
+            registry=None,
+        )
+        self._busy.set_function(lambda: len(self._pool.working))
+        self._utilization = Gauge(
+            "twisted_threadpool_utilization_ratio",
+            "Busy workers of the reactor's thread pool relative to its "
+            "maximum size.",
+            registry=None,
+        )
+        self._utilization.set_function(self._utilization_ratio)
+
+        # Register first, so a failed registration leaves no heartbeat behind.
+        if registry is not None:
+            registry.register(self)
+
+        self._beats = 0
+        self._call = LoopingCall.withCount(self._beat)
+        self._call.clock = reactor
+        self._call.start(interval, now=False)
+
+    def _beat(self, count: int) -> None:
+        # LoopingCall schedules on a fixed grid starting at starttime. The
+        # call we're in was due at the first grid point after the last call;
+        # count tells us how many grid points have passed since.
+        due = self._call.starttime + (self._beats + 1) * self._interval  # type: ignore[operator]
+        lag = max(0.0, self._reactor.seconds() - due)
+        self._beats += count
+
+        self._lag.observe(lag)
+        if lag > self._late_threshold:
+            self._late.inc()
+
+    def _utilization_ratio(self) -> float:
+        if not self._pool.max:
+            return 0.0
+
+        return len(self._pool.working) / self._pool.max
+
+    def describe(self) -> Iterable[Metric]:
+        return self.collect()
+
+    def collect(self) -> Iterable[Metric]:
+        return chain(
+            self._lag.collect(),
+            self._late.collect(),
+            self._queued.collect(),
+            self._busy.collect(),
+            self._utilization.collect(),
+        )
+
+    def close(self) -> None:
+        """
+        Stop monitoring and unregister from the registry.
+        """
+        if self._call.running:
+            self._call.stop()
+
+        # The heartbeat may have stopped on its own if it failed.
+        if self._registry is not None:
+            self._registry.unregister(self)
+            self._registry = None
+
+
+def start_reactor_monitor(
+    *,
+    interval: float = 0.5,
+    late_threshold: float = 0.1,
+    registry: CollectorRegistry | None = REGISTRY,
+    reactor: Any = None,
+) -> ReactorMonitor:
+    """
+    Start monitoring the health of *reactor*.
+
+    Every *interval* seconds, a heartbeat is run using a
+    :class:`twisted.internet.task.LoopingCall` and the following metrics are
+    updated:
+
+    - ``twisted_reactor_lag_seconds``: a histogram of how late the heartbeat
+      ran.  If the reactor is blocked, every other call waits this long, too.
+    - ``twisted_reactor_late_heartbeats_total``: the number of heartbeats
+      that were late by more than *late_threshold* seconds -- whether it's
+      one slow call or many short ones that held them up.
+
+    Additionally, the state of the reactor's thread pool -- that is used by
+    :func:`twisted.internet.threads.deferToThread` -- is read on every
+    scrape:
+
+    - ``twisted_threadpool_queued_calls``: calls waiting for a worker.
+    - ``twisted_threadpool_busy_workers``: workers running a call.
+    - ``twisted_threadpool_utilization_ratio``: busy workers relative to the
+      pool's maximum size.
+
+    :param float interval: Seconds between heartbeats.
+    :param float late_threshold: Lag in seconds beyond which a heartbeat
+        counts as late.
+    :param prometheus_client.CollectorRegistry registry: Where to register
+        the metrics.  ``None`` means not to register them at all.
+    :param reactor: The reactor to monitor.  ``None`` means the global one.
+
+    :rtype: ReactorMonitor
+
+    .. versionadded:: 26.2.0
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+
+    return ReactorMonitor(reactor, interval, late_threshold, registry)
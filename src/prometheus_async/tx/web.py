@@ -0,0 +1,184 @@
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2016 Hynek Schlawack
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Twisted-based metrics exposure.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from prometheus_client import REGISTRY
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThreadPool
+from twisted.logger import Logger
+from twisted.python.failure import Failure
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+
+from .._negotiation import _choose_generator
+
+
+if TYPE_CHECKING:
+    from typing import Any, Callable
+
+    from prometheus_client import CollectorRegistry
+    from twisted.internet.interfaces import IListeningPort
+    from twisted.web.server import Request
+
+
+_log = Logger()
+
+
+class _Renderer:
+    """
+    Render the exposition of *registry* in *reactor*'s thread pool.
+
+    Renders are single-flight per format: requests that arrive while a
+    render of the same format is running wait for it and share its result.
+    """
+
+    def __init__(self, registry: CollectorRegistry, reactor: Any) -> None:
+        self._registry = registry
+        self._reactor = reactor
+        self._waiting: dict[Callable, list[Deferred[bytes]]] = {}
+
+    def render(self, generate: Callable) -> Deferred[bytes]:
+        """
+        Return a Deferred that fires with the exposition created by
+        *generate*.
+        """
+        d: Deferred[bytes] = Deferred()
+
+        waiting = self._waiting.get(generate)
+        if waiting is not None:
+            waiting.append(d)
+            return d
+
+        self._waiting[generate] = [d]
+        deferToThreadPool(
+            self._reactor,
+            self._reactor.getThreadPool(),
+            generate,
+            self._registry,
+        ).addBoth(self._done, generate)
+
+        return d
+
+    def _done(self, result: bytes | Failure, generate: Callable) -> None:
+        for d in self._waiting.pop(generate):
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+class MetricsResource(Resource):
+    """
+    A :class:`twisted.web.resource.Resource` that serves the metrics of
+    *registry* without blocking the reactor.
+
+    The metrics are rendered in the reactor's thread pool using
+    :func:`twisted.internet.threads.deferToThreadPool` and concurrent
+    requests for the same format share a single render.  The format --
+    Prometheus's text format or OpenMetrics -- is chosen according to the
+    request's ``Accept`` header.
+
+    :param prometheus_client.CollectorRegistry registry: The registry to
+        serve.
+    :param reactor: The reactor to use.  ``None`` means the global one.
+
+    .. versionadded:: 26.2.0
+    """
+
+    isLeaf = True  # noqa: N815
+
+    def __init__(
+        self,
+        registry: CollectorRegistry = REGISTRY,
+        reactor: Any = None,
+    ) -> None:
+        super().__init__()  # type: ignore[no-untyped-call]
+
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self._renderer = _Renderer(registry, reactor)
+
+    def render_GET(self, request: Request) -> int:
+        accept = request.getHeader(b"Accept")
+        generate, content_type = _choose_generator(
+            accept.decode("ascii", "replace") if accept is not None else None
+        )
+        request.setHeader(  # type: ignore[no-untyped-call]
+            b"Content-Type", content_type.encode("ascii")
+        )
+
+        gone: list[Failure] = []
+        request.notifyFinish().addErrback(gone.append)
+
+        def write(body: bytes) -> None:
+            if not gone:
+                request.write(body)  # type: ignore[no-untyped-call]
+                request.finish()  # type: ignore[no-untyped-call]
+
+        def fail(failure: Failure) -> None:
+            _log.failure("Rendering metrics failed.", failure)
+            if not gone:
+                request.setResponseCode(500)
+                request.finish()  # type: ignore[no-untyped-call]
+
+        self._renderer.render(generate).addCallbacks(write, fail)
+
+        return NOT_DONE_YET
+
+
+def start_http_server(
+    *,
+    addr: str = "",
+    port: int = 0,
+    registry: CollectorRegistry = REGISTRY,
+    reactor: Any = None,
+) -> IListeningPort:
+    """
+    Start an HTTP server on *addr*:*port* that serves the metrics of
+    *registry* at ``/metrics`` using :class:`MetricsResource`.
+
+    :param str addr: Interface to listen on.  Leaving empty will listen on
+        all interfaces.
+    :param int port: Port to listen on.
+    :param prometheus_client.CollectorRegistry registry: The registry to
+        serve.
+    :param reactor: The reactor to use.  ``None`` means the global one.
+
+    :returns: The listening port.  Call its
+        :meth:`~twisted.internet.interfaces.IListeningPort.stopListening` to
+        stop the server.
+    :rtype: twisted.internet.interfaces.IListeningPort
+
+    .. versionadded:: 26.2.0
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+
+    root = Resource()  # type: ignore[no-untyped-call]
+    root.putChild(b"metrics", MetricsResource(registry, reactor))  # type: ignore[arg-type]
+
+    return reactor.listenTCP(
+        port,
+        Site(root),  # type: ignore[no-untyped-call]
+        interface=addr,
+    )
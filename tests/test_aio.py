@@ -15,27 +15,60 @@
 # limitations under the License.
 
 import asyncio
+import gzip
 import http.client
 import inspect
+import os
+import socket
 import sys
+import threading
+import time as blocking_time
 import uuid
 
+from concurrent.futures import ThreadPoolExecutor
 from types import SimpleNamespace
 from unittest import mock
+from urllib.parse import quote
 
 import pytest
 import wrapt
 
-from prometheus_client import CONTENT_TYPE_LATEST, Counter
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    values,
+)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
 from prometheus_client.openmetrics import exposition as openmetrics
 
 from prometheus_async import aio
+from prometheus_async.aio._exposition import (
+    ENCODERS,
+    _collector_key,
+    _count_series,
+    _iter_chunks,
+    _Limiter,
+    _OverloadedError,
+    _Renderer,
+    _Restricted,
+    _truncated,
+)
+from prometheus_async.aio._multiprocess import _CachedMultiProcessCollector
+from prometheus_async.aio._tracing import _ClientMetrics
 from prometheus_async.aio.sd import ConsulAgent, _LocalConsulAgentClient
 
 
 try:
     import aiohttp
 
+    from aiohttp import web
+    from aiohttp.test_utils import TestClient, TestServer
     from multidict import CIMultiDict
 except ImportError:
     aiohttp = None
@@ -360,6 +393,126 @@ class TestTrackInprogress:
         assert 0 == fake_gauge._val
 
 
+class CountingCollector:
+    """
+    A collector that counts how often it has been collected.
+    """
+
+    def __init__(self, name="counting"):
+        self.name = name
+        self.calls = 0
+
+    def collect(self):
+        self.calls += 1
+        yield GaugeMetricFamily(self.name, "calls", value=self.calls)
+
+
+class ThreadRecordingCollector:
+    """
+    A collector that records the names of the threads it's collected in.
+    """
+
+    def __init__(self):
+        self.threads = []
+
+    def collect(self):
+        self.threads.append(threading.current_thread().name)
+        yield GaugeMetricFamily("thread_recording", "threads", value=1)
+
+
+class BlockingCollector:
+    """
+    A collector that blocks collection until its event is set.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def describe(self):
+        return [GaugeMetricFamily("blocking", "blocks")]
+
+    def collect(self):
+        self.event.wait(5)
+        yield GaugeMetricFamily("blocking", "blocks", value=1)
+
+
+@pytest.fixture(name="deco", params=["time", "count_exceptions", "track"])
+def _deco(request, fake_observer, fake_counter, fake_gauge):
+    return {
+        "time": aio.time(fake_observer),
+        "count_exceptions": aio.count_exceptions(fake_counter),
+        "track": aio.track_inprogress(fake_gauge),
+    }[request.param]
+
+
+@pytest.mark.asyncio
+class TestFastPath:
+    async def test_plain_function(self, deco):
+        """
+        Plain functions are wrapped without wrapt and keep their name,
+        docstring, and signature.
+        """
+
+        async def func(x, *, y=1):
+            """Docstring."""
+            return x + y
+
+        wrapped = deco(func)
+
+        assert not isinstance(wrapped, wrapt.FunctionWrapper)
+        assert func is wrapped.__wrapped__
+        assert "func" == wrapped.__name__
+        assert "Docstring." == wrapped.__doc__
+        assert inspect.signature(func) == inspect.signature(wrapped)
+        assert inspect.iscoroutinefunction(wrapped)
+        assert 3 == await wrapped(1, y=2)
+
+    async def test_method(self, deco):
+        """
+        Plain functions that become methods are bound like undecorated ones.
+        """
+
+        class D:
+            @deco
+            async def meth(self, x):
+                return self, x
+
+        d = D()
+
+        assert (d, 42) == await d.meth(42)
+
+    async def test_generic(self, deco):
+        """
+        Everything that is not a plain function -- like bound methods or
+        classmethods -- is wrapped using wrapt.
+        """
+
+        class D:
+            @deco
+            @classmethod
+            async def cm(cls, x):
+                return cls, x
+
+        assert isinstance(deco(C().coro), wrapt.FunctionWrapper)
+        assert (D, 42) == await D.cm(42)
+
+    async def test_generic_exc(self, fake_counter):
+        """
+        Exceptions raised by callables wrapped using wrapt are counted, too.
+        """
+
+        class D:
+            @aio.count_exceptions(fake_counter, exc=ValueError)
+            @classmethod
+            async def cm(cls):
+                raise ValueError
+
+        with pytest.raises(ValueError):
+            await D.cm()
+
+        assert 1 == fake_counter._val
+
+
 class FakeSD:
     """
     Fake Service Discovery.
@@ -425,6 +578,35 @@ test_server_stats_created """
         )
         assert body.endswith("EOF\n")
 
+    async def test_server_stats_coalesced(self):
+        """
+        Concurrent requests for the same format share one render, different
+        formats don't.
+        """
+        collector = CountingCollector()
+        REGISTRY.register(collector)
+        collector.calls = 0
+        old = SimpleNamespace(headers=CIMultiDict())
+        om = SimpleNamespace(
+            headers=CIMultiDict(Accept="application/openmetrics-text")
+        )
+
+        rvs = await asyncio.gather(
+            aio.web.server_stats(old),
+            aio.web.server_stats(old),
+            aio.web.server_stats(om),
+            aio.web.server_stats(om),
+        )
+
+        assert 2 == collector.calls
+        assert rvs[0].body is rvs[1].body
+        assert rvs[2].body is rvs[3].body
+        assert rvs[0].body != rvs[2].body
+
+        await aio.web.server_stats(old)
+
+        assert 3 == collector.calls
+
     async def test_cheap(self):
         """
         Returns a simple string.
@@ -488,6 +670,7 @@ test_server_stats_created """
             assert sd.registered_ms is t._http_server
 
         s = t.socket
+        assert [s] == t.sockets
         h = http.client.HTTPConnection(s.addr, port=s[1])
         h.request("GET", "/metrics")
         rsp = h.getresponse()
@@ -501,6 +684,190 @@ test_server_stats_created """
 
         assert False is t._thread.is_alive()
 
+    @pytest.mark.parametrize(
+        ("kw", "match"),
+        [
+            ({"multiprocess": True}, "PROMETHEUS_MULTIPROC_DIR"),
+            ({"addr": []}, "Nothing to listen on."),
+        ],
+    )
+    async def test_start_in_thread_fails(self, monkeypatch, kw, match):
+        """
+        If the threaded server fails to start, the error is raised in the
+        calling thread and the server thread exits.
+        """
+        monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR", raising=False)
+        monkeypatch.delenv("prometheus_multiproc_dir", raising=False)
+        threads = set(threading.enumerate())
+
+        with pytest.raises(ValueError, match=match):
+            aio.web.start_http_server_in_thread(**kw)
+
+        assert threads == set(threading.enumerate())
+
+    async def test_render_in_thread(self):
+        """
+        If render_in_thread is passed, the metrics are rendered in a worker
+        thread, the timings are recorded, and the worker is shut down on
+        close.
+        """
+        collector = ThreadRecordingCollector()
+        REGISTRY.register(collector)
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1", render_in_thread=True
+        )
+
+        async with aiohttp.ClientSession() as s:
+            rv = await s.get(server.url + "metrics")
+            body = await rv.text()
+
+        await server.close()
+
+        assert collector.threads[-1].startswith("PrometheusAsyncRender")
+        assert "prometheus_async_render_duration_seconds_count" in body
+        assert "prometheus_async_render_queued_seconds_count" in body
+
+    async def test_render_metrics_lifecycle(self):
+        """
+        The render metrics belong to their server: they're unregistered on
+        close, so the next server exposes its own.
+        """
+        for _ in range(2):
+            server = await aio.web.start_http_server(
+                addr="127.0.0.1", render_in_thread=True
+            )
+
+            async with aiohttp.ClientSession() as s:
+                await (await s.get(server.url + "metrics")).read()
+
+            assert 1 == REGISTRY.get_sample_value(
+                "prometheus_async_render_duration_seconds_count"
+            )
+
+            await server.close()
+
+            assert None is REGISTRY.get_sample_value(
+                "prometheus_async_render_duration_seconds_count"
+            )
+
+    async def test_import_creates_no_metrics(self, tmp_path):
+        """
+        Importing doesn't create any metrics, so it doesn't create any files
+        in multiprocess mode either.
+        """
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-c",
+            "import prometheus_async.aio.web",
+            env={**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)},
+        )
+
+        assert 0 == await proc.wait()
+        assert [] == os.listdir(tmp_path)
+
+    async def test_render_executor(self):
+        """
+        A passed executor is used for rendering and not shut down.
+        """
+        collector = ThreadRecordingCollector()
+        REGISTRY.register(collector)
+        executor = ThreadPoolExecutor(thread_name_prefix="Custom")
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1", executor=executor
+        )
+
+        async with aiohttp.ClientSession() as s:
+            rv = await s.get(server.url + "metrics")
+            await rv.text()
+
+        await server.close()
+
+        assert collector.threads[-1].startswith("Custom")
+        assert 42 == executor.submit(lambda: 42).result()
+
+        executor.shutdown()
+
+    @pytest.mark.skipif(
+        not hasattr(socket, "SO_REUSEPORT"), reason="Needs SO_REUSEPORT."
+    )
+    async def test_reuse_port(self):
+        """
+        With reuse_port, multiple servers can listen on the same port.
+        """
+        first = await aio.web.start_http_server(
+            addr="127.0.0.1", reuse_port=True
+        )
+        second = await aio.web.start_http_server(
+            addr="127.0.0.1", port=first.socket.port, reuse_port=True
+        )
+
+        async with aiohttp.ClientSession() as s:
+            rv = await s.get(second.url + "metrics")
+
+        await first.close()
+        await second.close()
+
+        assert 200 == rv.status
+        assert first.socket == second.socket
+
+    async def test_registries(self):
+        """
+        Multiple registries can be served on their own paths, and a slow
+        registry doesn't hold up the others.
+        """
+        fast = CollectorRegistry()
+        Counter("test_fast", "cnt", registry=fast).inc()
+        slow = CollectorRegistry()
+        collector = BlockingCollector()
+        slow.register(collector)
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1",
+            registry={"/metrics": fast, "/slow": slow},
+            render_in_thread=True,
+        )
+
+        async with aiohttp.ClientSession() as s:
+            slow_rv = asyncio.create_task(s.get(server.url + "slow"))
+            await asyncio.sleep(0.05)
+            fast_body = await (await s.get(server.url + "metrics")).text()
+
+            assert not slow_rv.done()
+
+            collector.event.set()
+            slow_body = await (await slow_rv).text()
+
+        await server.close()
+
+        assert "test_fast_total 1.0" in fast_body
+        assert "blocking" not in fast_body
+        assert "blocking 1.0" in slow_body
+        assert "test_fast" not in slow_body
+
+    async def test_registries_own_metrics(self):
+        """
+        Each path exposes the metrics of its own renders and scrapes.
+        """
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1",
+            registry={"/a": CollectorRegistry(), "/b": CollectorRegistry()},
+            render_in_thread=True,
+            instrument=True,
+        )
+
+        async with aiohttp.ClientSession() as s:
+            for _ in range(5):
+                await (await s.get(server.url + "a")).read()
+            for _ in range(2):
+                body = await (await s.get(server.url + "b")).text()
+
+        await server.close()
+
+        assert "prometheus_async_render_duration_seconds_count 1.0" in body
+        assert (
+            'prometheus_async_scrape_duration_seconds_count{format="text"} '
+            "1.0" in body
+        )
+
     @pytest.mark.parametrize(("addr", "url"), [("127.0.0.1", "127.0.0.1:")])
     async def test_url(self, addr, url):
         """
@@ -517,129 +884,1984 @@ test_server_stats_created """
 
         await server.close()
 
-
-@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
-@pytest.mark.asyncio
-class TestConsulAgent:
-    @pytest.mark.parametrize("deregister", [True, False])
-    async def test_integration(self, deregister):
+    async def test_multiple_addrs(self):
         """
-        Integration test with a real consul agent. Start a service, register
-        it, close it, verify it's deregistered.
+        If multiple addresses are passed, the server listens on all of them
+        and reports all sockets.
         """
-        tags = ("foo", "bar")
-        service_id = str(uuid.uuid4())  # allow for parallel tests
-
-        con = _LocalConsulAgentClient(token=None)
-        ca = ConsulAgent(
-            name="test-metrics",
-            service_id=service_id,
-            tags=tags,
-            deregister=deregister,
+        server = await aio.web.start_http_server(
+            addr=["127.0.0.1", "127.0.0.1"]
         )
 
-        try:
-            server = await aio.web.start_http_server(
-                addr="127.0.0.1", service_discovery=ca
-            )
-        except aiohttp.ClientOSError:
-            pytest.skip("Missing consul agent.")
+        async with aiohttp.ClientSession() as s:
+            statuses = [
+                (await s.get(f"http://{addr}:{port}/metrics")).status
+                for addr, port in server.sockets
+            ]
 
-        svc = (await con.get_services())[service_id]
+        await server.close()
 
-        assert "test-metrics" == svc["Service"]
-        assert sorted(tags) == sorted(svc["Tags"])
-        assert server.socket.addr == svc["Address"]
-        assert server.socket.port == svc["Port"]
+        assert server.socket == server.sockets[0]
+        assert 2 == len({sock.port for sock in server.sockets})
+        assert [200, 200] == statuses
 
-        await server.close()
+    @pytest.mark.parametrize("prefix", [None, "/prom"])
+    async def test_add_metrics_routes(self, prefix):
+        """
+        The metrics endpoints can be added to an existing app or a sub-app,
+        and their background work is tied to the app.
+        """
+        Counter("test_mounted", "cnt").inc()
+        app = web.Application()
+        metrics = app if prefix is None else web.Application()
+        aio.web.add_metrics_routes(
+            metrics,
+            compress=True,
+            compress_min_size=0,
+            render_in_thread=True,
+            prerender_interval=60,
+        )
+        if prefix is not None:
+            app.add_subapp(prefix, metrics)
 
-        services = await con.get_services()
+        async with TestClient(TestServer(app)) as client:
+            rv = await client.get(
+                f"{prefix or ''}/metrics",
+                headers={"Accept-Encoding": "gzip"},
+            )
+            body = await rv.text()
 
-        if deregister:
-            # Assert service is gone iff we are supposed to deregister.
-            assert service_id not in services
-        else:
-            assert service_id in services
+        assert "gzip" == rv.headers["Content-Encoding"]
+        assert "test_mounted_total 1.0" in body
+        assert "prometheus_async_render_duration_seconds_count" in body
 
-            # Clean up behind ourselves.
-            resp = await con.deregister_service(service_id)
-            assert 200 == resp.status
+    async def test_nothing_to_listen_on(self):
+        """
+        If neither addresses nor a Unix domain socket are passed, ValueError
+        is raised.
+        """
+        with pytest.raises(ValueError, match="Nothing to listen on"):
+            await aio.web.start_http_server(addr=[])
 
-    @pytest.mark.parametrize("deregister", [True, False])
-    @pytest.mark.skipif(sys.version_info < (3, 8), reason="AsyncMock is 3.8+")
-    async def test_mocked(self, deregister):
+    @pytest.mark.skipif(
+        not hasattr(socket, "AF_UNIX"), reason="Needs Unix domain sockets."
+    )
+    async def test_unix(self, tmp_path):
         """
-        Same as test_integration, but using mocks instead of a real consul
-        agent.
+        The server can listen on a Unix domain socket only and reports its
+        path.
         """
-        tags = ("foo", "bar")
-        service_id = str(uuid.uuid4())  # allow for parallel tests
+        Counter("test_unix", "cnt").inc()
+        path = str(tmp_path / "metrics.sock")
+        server = await aio.web.start_http_server(unix_path=path)
 
-        con = mock.AsyncMock(auto_spec=_LocalConsulAgentClient)
-        ca = ConsulAgent(
-            name="test-metrics",
-            service_id=service_id,
-            tags=tags,
-            deregister=deregister,
-        )
-        ca.consul = con
+        async with aiohttp.ClientSession(
+            connector=aiohttp.UnixConnector(path=path)
+        ) as s:
+            body = await (await s.get("http://localhost/metrics")).text()
 
-        server = await aio.web.start_http_server(
-            addr="127.0.0.1", service_discovery=ca
-        )
+        await server.close()
 
-        con.register_service.assert_awaited_once()
-        reg = con.register_service.await_args.kwargs
+        assert path == server.socket
+        assert "http+unix://" + quote(path, safe="") + "/" == server.url
+        assert "test_unix_total 1.0" in body
 
-        assert service_id == reg["service_id"]
-        assert "test-metrics" == reg["name"]
-        assert sorted(tags) == sorted(reg["tags"])
-        assert (
-            f"http://{server.socket.addr}:{server.socket.port}/"
-            == reg["metrics_server"].url
+    @pytest.mark.skipif(
+        not hasattr(socket, "AF_UNIX"), reason="Needs Unix domain sockets."
+    )
+    async def test_unix_and_tcp(self, tmp_path):
+        """
+        If an address is passed, too, the server listens on TCP and on the
+        Unix domain socket, and reports the TCP socket.
+        """
+        path = str(tmp_path / "metrics.sock")
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1", unix_path=path
         )
 
+        async with aiohttp.ClientSession(
+            connector=aiohttp.UnixConnector(path=path)
+        ) as s:
+            unix_rv = await s.get("http://localhost/metrics")
+        async with aiohttp.ClientSession() as s:
+            tcp_rv = await s.get(server.url + "metrics")
+
         await server.close()
 
-        if deregister:
-            # Assert service is gone iff we are supposed to deregister.
-            con.deregister_service.assert_awaited_once_with(service_id)
-        else:
-            con.deregister_service.assert_not_called()
+        assert "127.0.0.1" == server.socket.addr
+        assert path == server.sockets[-1]
+        assert [200, 200] == [unix_rv.status, tcp_rv.status]
 
-    async def test_none_if_register_fails(self):
+    @pytest.mark.skipif(
+        not hasattr(socket, "AF_UNIX"), reason="Needs Unix domain sockets."
+    )
+    async def test_site_fails(self, tmp_path):
         """
-        If register fails, return None.
+        If a site fails to start, the sites that did start are shut down.
         """
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+
+        with pytest.raises(OSError):
+            await aio.web.start_http_server(
+                addr="127.0.0.1",
+                port=port,
+                unix_path=str(tmp_path / "nope" / "metrics.sock"),
+            )
 
-        class FakeMetricsServer:
-            socket = mock.Mock(addr="127.0.0.1", port=12345)
-            url = "http://127.0.0.1:12345/metrics"
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", port))
 
-        class FakeSession:
-            async def __aexit__(self, exc_type, exc_value, traceback):
-                pass
 
-            async def __aenter__(self):
-                class FakeConnection:
-                    async def put(self, *args, **kw):
-                        return mock.Mock(status=400)
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+class TestChooseEncoding:
+    @pytest.mark.parametrize(
+        ("header", "encoding"),
+        [
+            (None, None),
+            ("", None),
+            ("identity", None),
+            ("gzip", "gzip"),
+            ("GZIP", "gzip"),
+            ("br, gzip;q=0.5", "gzip"),
+            ("gzip;q=0", None),
+            ("*", next(iter(ENCODERS))),
+            ("*, gzip;q=0", "zstd" if "zstd" in ENCODERS else None),
+            ("gzip;q=bogus", None),
+            ("gzip;level=1", "gzip"),
+        ],
+    )
+    def test_choose(self, header, encoding):
+        """
+        The most preferred encoding that we support and the client accepts
+        wins.
+        """
+        assert encoding == aio.web._choose_encoding(header)
 
-                return FakeConnection()
 
-        ca = ConsulAgent()
-        ca.consul.session_factory = FakeSession
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+@pytest.mark.asyncio
+class TestCompression:
+    def view(self, **kw):
+        return aio.web._MetricsView(
+            _Renderer(REGISTRY, keep_latest=True), compress=True, **kw
+        )
 
-        assert None is (await ca.register(FakeMetricsServer()))
+    async def test_gzip(self):
+        """
+        If the client accepts gzip, the body is compressed and the compressed
+        body is cached along the rendered one.
+        """
+        Counter("test_gzip_total", "cnt").inc()
+        view = self.view(compress_min_size=0)
+        req = SimpleNamespace(headers=CIMultiDict({"Accept-Encoding": "gzip"}))
 
+        rv = await view(req)
+        rv2 = await view(req)
 
-@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
-class TestLocalConsulAgentClient:
-    def test_sets_headers(self):
+        assert "gzip" == rv.headers["Content-Encoding"]
+        assert "Accept-Encoding" == rv.headers["Vary"]
+        assert b"test_gzip_total 1.0" in gzip.decompress(rv.body)
+        assert rv.body is rv2.body
+
+    async def test_not_accepted(self):
         """
-        If a token is passed, "X-Consul-Token" header is set.
+        If the client doesn't accept any of our encodings, the body is sent
+        as is.
         """
-        con = _LocalConsulAgentClient(token="token42")
+        view = self.view(compress_min_size=0)
+        rv = await view(SimpleNamespace(headers=CIMultiDict()))
 
-        assert "token42" == con.headers["X-Consul-Token"]
+        assert "Content-Encoding" not in rv.headers
+        assert "Accept-Encoding" == rv.headers["Vary"]
+
+    async def test_min_size(self):
+        """
+        Bodies below compress_min_size are not compressed.
+        """
+        view = self.view(compress_min_size=1024 * 1024)
+        req = SimpleNamespace(headers=CIMultiDict({"Accept-Encoding": "gzip"}))
+
+        rv = await view(req)
+
+        assert "Content-Encoding" not in rv.headers
+
+    async def test_level(self):
+        """
+        compress_level is passed to the encoder.
+        """
+        for i in range(100):
+            Counter(f"test_level_{i}_total", "cnt").inc(i)
+        req = SimpleNamespace(headers=CIMultiDict({"Accept-Encoding": "gzip"}))
+
+        fast = await self.view(compress_min_size=0, compress_level=1)(req)
+        best = await self.view(compress_min_size=0, compress_level=9)(req)
+
+        assert gzip.decompress(fast.body) == gzip.decompress(best.body)
+        assert len(fast.body) > len(best.body)
+
+    async def test_start_http_server(self):
+        """
+        Integration test: compression can be enabled on the metrics server.
+        """
+        Counter("test_compressed_total", "cnt").inc()
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1", compress=True, compress_min_size=0
+        )
+
+        async with aiohttp.ClientSession() as s:
+            rv = await s.get(
+                server.url + "metrics",
+                headers={"Accept-Encoding": "gzip"},
+            )
+            body = await rv.text()
+
+        await server.close()
+
+        assert "gzip" == rv.headers["Content-Encoding"]
+        assert "test_compressed_total 1.0" in body
+
+
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+class TestETagMatches:
+    @pytest.mark.parametrize(
+        ("header", "matches"),
+        [
+            (None, False),
+            ("", False),
+            ('"abc"', True),
+            ('W/"abc"', True),
+            ('"xyz", "abc"', True),
+            ('"xyz"', False),
+            ("*", True),
+        ],
+    )
+    def test_etag_matches(self, header, matches):
+        """
+        If-None-Match headers are matched using weak comparison.
+        """
+        assert matches is aio.web._etag_matches('"abc"', header)
+
+
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+@pytest.mark.asyncio
+class TestETag:
+    async def test_not_modified(self):
+        """
+        If the exposition didn't change, conditional requests get a 304.
+        Once it changes, they get the new exposition.
+        """
+        c = Counter("test_not_modified", "cnt")
+        view = aio.web._MetricsView(
+            _Renderer(REGISTRY, keep_latest=True), etag=True
+        )
+
+        rv = await view(SimpleNamespace(headers=CIMultiDict()))
+        etag = rv.headers["ETag"]
+        cond = SimpleNamespace(headers=CIMultiDict({"If-None-Match": etag}))
+        rv2 = await view(cond)
+
+        c.inc()
+        rv3 = await view(cond)
+
+        assert 200 == rv.status
+        assert 304 == rv2.status
+        assert etag == rv2.headers["ETag"]
+        assert rv2.body is None
+        assert 200 == rv3.status
+        assert etag != rv3.headers["ETag"]
+        assert b"test_not_modified_total 1.0" in rv3.body
+
+    async def test_stream(self):
+        """
+        ETags can't be combined with streaming.
+        """
+        with pytest.raises(ValueError, match="etag can't be combined"):
+            aio.web.add_metrics_routes(
+                web.Application(), etag=True, stream=True
+            )
+
+    async def test_encoded(self):
+        """
+        Encoded representations have their own ETags and are not encoded if
+        the request is answered with a 304.
+        """
+        Counter("test_encoded", "cnt")
+        view = aio.web._MetricsView(
+            _Renderer(REGISTRY, keep_latest=True),
+            etag=True,
+            compress=True,
+            compress_min_size=0,
+        )
+        req = SimpleNamespace(headers=CIMultiDict({"Accept-Encoding": "gzip"}))
+
+        plain = await view(SimpleNamespace(headers=CIMultiDict()))
+        rv = await view(req)
+        req.headers["If-None-Match"] = rv.headers["ETag"]
+        rv2 = await view(req)
+
+        assert plain.headers["ETag"] != rv.headers["ETag"]
+        assert rv.headers["ETag"].endswith('-gzip"')
+        assert 304 == rv2.status
+        assert "Content-Encoding" not in rv2.headers
+
+
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+class TestScrapeTimeout:
+    @pytest.mark.parametrize(
+        ("header", "timeout"),
+        [
+            (None, None),
+            ("", None),
+            ("nope", None),
+            ("0", None),
+            ("-1", None),
+            ("10", 9.5),
+            ("0.5", 0.25),
+        ],
+    )
+    def test_scrape_timeout(self, header, timeout):
+        """
+        The scrape timeout header is parsed and an offset is subtracted.
+        """
+        assert timeout == aio.web._scrape_timeout(header)
+
+
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+@pytest.mark.asyncio
+class TestDeadline:
+    @pytest.fixture(name="blocking")
+    def _blocking(self):
+        collector = BlockingCollector()
+        registry = CollectorRegistry()
+        Counter("before", "before", registry=registry).inc()
+        registry.register(collector)
+        with ThreadPoolExecutor() as executor:
+            yield collector, _Renderer(registry, executor=executor)
+
+            collector.event.set()
+
+    @pytest.mark.parametrize(
+        "generate", [generate_latest, openmetrics.generate_latest]
+    )
+    async def test_partial(self, blocking, generate):
+        """
+        If there's no previous render, what has been rendered so far is
+        returned, followed by a marker metric.
+        """
+        collector, r = blocking
+
+        snapshot = await r.render(generate, timeout=0.01)
+
+        body = snapshot.body.decode()
+        assert "blocking" not in body
+        assert "prometheus_async_scrape_truncated 1.0\n" in body
+        if generate is openmetrics.generate_latest:
+            assert body.endswith("# EOF\n")
+            assert 1 == body.count("# EOF")
+
+        collector.event.set()
+        full = await r.render(generate, timeout=1)
+
+        assert b"blocking 1.0" in full.body
+        assert b"truncated" not in full.body
+
+    async def test_stale(self, blocking):
+        """
+        If there's a previous render, it's served if the render takes too
+        long.
+        """
+        collector, r = blocking
+        collector.event.set()
+        good = await r.render(generate_latest)
+        collector.event.clear()
+
+        assert good is await r.render(generate_latest, timeout=0.01)
+
+    async def test_not_started(self, blocking):
+        """
+        If the render hasn't started yet when the scrape times out, there's
+        nothing to serve but its result.
+        """
+        collector, r = blocking
+        collector.event.set()
+        started = asyncio.Event()
+        _generate = r._generate
+
+        async def late_generate(generate):
+            await started.wait()
+
+            return await _generate(generate)
+
+        with mock.patch.object(r, "_generate", late_generate):
+            scrape = asyncio.create_task(
+                r.render(generate_latest, timeout=0.01)
+            )
+            await asyncio.sleep(0.05)
+
+            assert not scrape.done()
+
+            started.set()
+            snapshot = await scrape
+
+        assert b"blocking 1.0" in snapshot.body
+        assert b"truncated" not in snapshot.body
+
+    async def test_truncated_complete(self):
+        """
+        If the progress already contains the end of the exposition, it's
+        moved behind the marker metric.
+        """
+        chunks = [b"a 1.0\n", b"# EOF\n"]
+
+        body = _truncated(openmetrics.generate_latest, chunks)
+
+        assert body.startswith(b"a 1.0\n")
+        assert body.endswith(b"prometheus_async_scrape_truncated 1.0\n# EOF\n")
+        assert 1 == body.count(b"# EOF")
+
+    async def test_start_http_server(self):
+        """
+        Integration test: the scrape timeout header is honored.
+        """
+        collector = BlockingCollector()
+        REGISTRY.register(collector)
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1", render_in_thread=True
+        )
+
+        async with aiohttp.ClientSession() as s:
+            rv = await s.get(
+                server.url + "metrics",
+                headers={"X-Prometheus-Scrape-Timeout-Seconds": "0.1"},
+            )
+            body = await rv.text()
+
+        collector.event.set()
+        await server.close()
+
+        assert "prometheus_async_scrape_truncated 1.0" in body
+
+
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+@pytest.mark.asyncio
+class TestLimiter:
+    async def test_queue_and_reject(self):
+        """
+        Acquirers beyond the limit are queued until the queue is full, after
+        which they're rejected.
+        """
+        limiter = _Limiter(1, 1)
+        await limiter.acquire()
+
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+
+        with pytest.raises(_OverloadedError):
+            await limiter.acquire()
+
+        assert not waiter.done()
+
+        limiter.release()
+        await waiter
+
+        limiter.release()
+
+        assert 0 == limiter._active
+
+    async def test_cancelled_waiter(self):
+        """
+        Cancelled waiters give up their place in the queue.
+        """
+        limiter = _Limiter(1, 1)
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+        assert not limiter._waiters
+
+        limiter.release()
+
+        assert 0 == limiter._active
+
+    async def test_cancelled_after_handover(self):
+        """
+        A waiter that's cancelled after it has been handed a slot passes it
+        on.
+        """
+        limiter = _Limiter(1, 1)
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+
+        limiter.release()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+        assert 0 == limiter._active
+
+    async def test_release_skips_cancelled(self):
+        """
+        Slots aren't handed to waiters that have been cancelled but haven't
+        left the queue yet.
+        """
+        limiter = _Limiter(1, 2)
+        await limiter.acquire()
+        cancelled = asyncio.create_task(limiter.acquire())
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+
+        cancelled.cancel()
+        limiter.release()
+        await waiter
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+
+        assert 1 == limiter._active
+
+        limiter.release()
+
+        assert 0 == limiter._active
+
+    async def test_join_render_started_while_queued(self):
+        """
+        Scrapes that get a slot after somebody else has started the same
+        render in the meantime join it and give their slot back.
+        """
+        r = _Renderer(REGISTRY, max_concurrent_renders=2, max_queued_scrapes=2)
+        await r._limiter.acquire()
+        await r._limiter.acquire()
+        scrapes = [
+            asyncio.create_task(r.render(generate_latest)) for _ in range(2)
+        ]
+        await asyncio.sleep(0)
+
+        r._limiter.release()
+        r._limiter.release()
+        s1, s2 = await asyncio.gather(*scrapes)
+
+        assert s1 is s2
+        assert 0 == r._limiter._active
+
+    async def test_stream_rejected(self):
+        """
+        Streamed scrapes hold a render slot and are rejected if there's none.
+        """
+        collector = BlockingCollector()
+        REGISTRY.register(collector)
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1",
+            stream=True,
+            render_in_thread=True,
+            max_concurrent_renders=1,
+        )
+
+        async with aiohttp.ClientSession() as s:
+            url = server.url + "metrics"
+            blocked = asyncio.create_task(s.get(url))
+            await asyncio.sleep(0.1)
+
+            rejected = await s.get(url)
+            collector.event.set()
+            rv = await blocked
+            body = await rv.text()
+
+        await server.close()
+
+        assert 503 == rejected.status
+        assert 200 == rv.status
+        assert "prometheus_async_scrapes_rejected_total 1.0" in body
+
+    async def test_start_http_server(self):
+        """
+        Integration test: if all render slots are busy, scrapes are rejected
+        with a 503 unless they can join a render in flight.
+        """
+        collector = BlockingCollector()
+        REGISTRY.register(collector)
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1", render_in_thread=True, max_concurrent_renders=1
+        )
+
+        async with aiohttp.ClientSession() as s:
+            url = server.url + "metrics"
+            text = asyncio.create_task(s.get(url))
+            joined = asyncio.create_task(s.get(url))
+            await asyncio.sleep(0.1)
+
+            rejected = await s.get(
+                url, headers={"Accept": "application/openmetrics-text"}
+            )
+            collector.event.set()
+            rvs = await asyncio.gather(text, joined)
+
+        await server.close()
+
+        assert 503 == rejected.status
+        assert "1" == rejected.headers["Retry-After"]
+        assert [200, 200] == [rv.status for rv in rvs]
+        assert "prometheus_async_scrapes_rejected_total" in await rvs[0].text()
+
+    @pytest.mark.parametrize("limit", [0, -1])
+    async def test_no_slots(self, limit):
+        """
+        At least one render slot is required.
+        """
+        with pytest.raises(ValueError, match="max_concurrent_renders"):
+            aio.web.add_metrics_routes(
+                web.Application(), max_concurrent_renders=limit
+            )
+
+
+class DescribedCountingCollector(CountingCollector):
+    """
+    A counting collector that describes its metrics so it can be indexed.
+    """
+
+    def describe(self):
+        return [GaugeMetricFamily(self.name, "calls")]
+
+
+class TestRestricted:
+    @pytest.fixture(name="registry")
+    def _registry(self):
+        registry = CollectorRegistry()
+        Counter("app_requests", "requests", registry=registry).inc()
+        Counter("app_errors", "errors", registry=registry).inc()
+        Counter("other", "other", registry=registry).inc()
+        expensive = DescribedCountingCollector("expensive")
+        registry.register(expensive)
+
+        return registry, expensive
+
+    def test_names(self, registry):
+        """
+        Only samples with the selected names are collected and unselected
+        collectors are never called.
+        """
+        registry, expensive = registry
+
+        families = list(
+            _Restricted(registry, ["app_errors_total", "nope"], []).collect()
+        )
+
+        assert 0 == expensive.calls
+        assert [("app_errors", ["app_errors_total"])] == [
+            (f.name, [s.name for s in f.samples]) for f in families
+        ]
+
+    def test_family_name(self, registry):
+        """
+        Selecting a family by its name selects all of its samples.
+        """
+        registry, _ = registry
+
+        families = list(_Restricted(registry, ["other"], []).collect())
+
+        assert [["other_total", "other_created"]] == [
+            [s.name for s in f.samples] for f in families
+        ]
+
+    def test_prefixes(self, registry):
+        """
+        Prefixes select all samples whose names start with them, in
+        registration order.
+        """
+        registry, expensive = registry
+
+        families = list(_Restricted(registry, [], ["app_"]).collect())
+
+        assert 0 == expensive.calls
+        assert ["app_requests", "app_errors"] == [f.name for f in families]
+
+    def test_undescribed(self, registry):
+        """
+        Collectors that don't describe their metrics are always collected
+        and filtered.
+        """
+        registry, _ = registry
+        undescribed = CountingCollector("undescribed")
+        registry.register(undescribed)
+
+        selected = list(_Restricted(registry, ["undescribed"], []).collect())
+        unselected = list(_Restricted(registry, ["other"], []).collect())
+
+        assert 2 == undescribed.calls
+        assert ["undescribed"] == [f.name for f in selected]
+        assert ["other"] == [f.name for f in unselected]
+
+    def test_target_info(self):
+        """
+        The target info of a registry can be selected.
+        """
+        registry = CollectorRegistry(target_info={"env": "test"})
+        Counter("other", "other", registry=registry).inc()
+
+        families = list(_Restricted(registry, ["target_info"], []).collect())
+
+        assert ["target"] == [f.name for f in families]
+
+    def test_collector(self):
+        """
+        Collectors that aren't registries are collected and filtered.
+        """
+        collector = CountingCollector()
+
+        assert ["counting"] == [
+            f.name for f in _Restricted(collector, ["counting"], []).collect()
+        ]
+        assert [] == list(_Restricted(collector, ["nope"], []).collect())
+
+
+def write_counter(pid, value):
+    """
+    Create a counter whose value is written to the multiprocess file of *pid*
+    and increment it by *value*.
+    """
+    with mock.patch.object(
+        values, "ValueClass", values.MultiProcessValue(lambda: pid)
+    ):
+        c = Counter("mp", "mp", registry=None)
+    c.inc(value)
+
+    return c
+
+
+def close(metric):
+    """
+    Close the multiprocess file of *metric*.
+    """
+    metric._value._file.close()
+
+
+@pytest.fixture(name="mp_dir")
+def _mp_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    # prometheus_client before 0.10 only knows the lowercase name.
+    monkeypatch.setenv("prometheus_multiproc_dir", str(tmp_path))
+
+    return tmp_path
+
+
+@pytest.fixture(name="mp_values")
+def _mp_values(mp_dir, monkeypatch):
+    """
+    Write the values of metrics created from now on to *mp_dir*, like in a
+    process that was started with PROMETHEUS_MULTIPROC_DIR set.
+    """
+    value_class = values.MultiProcessValue()
+    created = []
+
+    def create(*args, **kw):
+        value = value_class(*args, **kw)
+        created.append(value)
+
+        return value
+
+    monkeypatch.setattr(values, "ValueClass", create)
+
+    yield mp_dir
+
+    for f in {id(v._file): v._file for v in created}.values():
+        f.close()
+
+
+class TestCachedMultiProcessCollector:
+    def test_aggregates(self, mp_dir):
+        """
+        The values of all processes are aggregated.
+        """
+        for pid, value in ((1, 1.0), (2, 2.0)):
+            close(write_counter(pid, value))
+        registry = CollectorRegistry()
+        registry.register(_CachedMultiProcessCollector())
+
+        assert 3.0 == registry.get_sample_value("mp_total")
+
+    def test_only_changed_files_are_parsed(self, mp_dir):
+        """
+        Only files that changed are parsed again -- even if they've been
+        changed in-place without bumping their modification time.
+        """
+        c1 = write_counter(1, 1.0)
+        close(write_counter(2, 2.0))
+        c = _CachedMultiProcessCollector()
+        list(c.collect())
+
+        with mock.patch.object(
+            MultiProcessCollector,
+            "_read_metrics",
+            wraps=MultiProcessCollector._read_metrics,
+        ) as read:
+            unchanged = c.collect()
+
+            assert unchanged is c.collect()
+            assert 0 == read.call_count
+
+            mtime = os.stat(mp_dir / "counter_1.db").st_mtime_ns
+            c1.inc(4.0)
+            os.utime(mp_dir / "counter_1.db", ns=(mtime, mtime))
+            changed = list(c.collect())
+
+        close(c1)
+
+        assert [mock.call([str(mp_dir / "counter_1.db")])] == (
+            read.call_args_list
+        )
+        assert [7.0] == [
+            s.value for s in changed[0].samples if s.name == "mp_total"
+        ]
+
+    def test_reads_used_part(self, mp_dir):
+        """
+        Only the used part of the files is read and kept.
+        """
+        close(write_counter(1, 1.0))
+        f = mp_dir / "counter_1.db"
+        c = _CachedMultiProcessCollector()
+        list(c.collect())
+
+        data = c._files[str(f)].data
+
+        assert len(data) == int.from_bytes(data[:4], sys.byteorder)
+        assert len(data) < os.stat(f).st_size
+        assert f.read_bytes().startswith(data)
+
+    def test_removed_files(self, mp_dir):
+        """
+        Files that vanish are forgotten.
+        """
+        close(write_counter(1, 1.0))
+        close(write_counter(2, 2.0))
+        c = _CachedMultiProcessCollector()
+        list(c.collect())
+
+        (mp_dir / "counter_2.db").unlink()
+
+        assert [1.0] == [
+            s.value
+            for m in c.collect()
+            for s in m.samples
+            if s.name == "mp_total"
+        ]
+        assert [str(mp_dir / "counter_1.db")] == list(c._files)
+
+    def test_removed_while_collecting(self, mp_dir):
+        """
+        Files that vanish between listing and reading them are forgotten.
+        """
+        close(write_counter(1, 1.0))
+        close(write_counter(2, 2.0))
+        files = [str(mp_dir / "counter_1.db"), str(mp_dir / "counter_2.db")]
+        c = _CachedMultiProcessCollector()
+        list(c.collect())
+
+        (mp_dir / "counter_2.db").unlink()
+        with mock.patch("glob.glob", return_value=files):
+            metrics = list(c.collect())
+
+        assert [1.0] == [
+            s.value for m in metrics for s in m.samples if s.name == "mp_total"
+        ]
+        assert [files[0]] == list(c._files)
+
+    @pytest.mark.parametrize(
+        "mode", ["all", "liveall", "livesum", "max", "min"]
+    )
+    def test_gauges(self, mp_dir, mode):
+        """
+        Gauges are aggregated according to their multiprocess mode, like
+        prometheus_client does.
+        """
+        for pid, value in ((1, 1.0), (2, 2.0)):
+            with mock.patch.object(
+                values, "ValueClass", values.MultiProcessValue(lambda p=pid: p)
+            ):
+                g = Gauge(
+                    "mp_gauge", "gauge", multiprocess_mode=mode, registry=None
+                )
+            g.set(value)
+            close(g)
+
+        expected = list(
+            MultiProcessCollector(None, path=str(mp_dir)).collect()
+        )
+        got = _CachedMultiProcessCollector(str(mp_dir)).collect()
+
+        def samples(metrics):
+            return [
+                {
+                    (s.name, tuple(sorted(s.labels.items())), s.value)
+                    for s in m.samples
+                }
+                for m in metrics
+            ]
+
+        assert samples(expected) == samples(got)
+
+    def test_no_dir(self, monkeypatch):
+        """
+        If PROMETHEUS_MULTIPROC_DIR isn't set, ValueError is raised.
+        """
+        monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR", raising=False)
+
+        with pytest.raises(ValueError, match="PROMETHEUS_MULTIPROC_DIR"):
+            _CachedMultiProcessCollector()
+
+
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+@pytest.mark.asyncio
+class TestRestrictedServer:
+    @pytest.mark.parametrize("stream", [True, False])
+    async def test_start_http_server(self, stream):
+        """
+        Integration test: metrics can be selected using name[] and prefix[].
+        """
+        Counter("app_requests", "requests").inc()
+        Counter("app_errors", "errors").inc()
+        Counter("other", "other").inc()
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1", stream=stream
+        )
+
+        async with aiohttp.ClientSession() as s:
+            rv = await s.get(
+                server.url + "metrics",
+                params=[("name[]", "other_total"), ("prefix[]", "app_e")],
+            )
+            body = await rv.text()
+
+        await server.close()
+
+        assert (
+            "# HELP app_errors_total errors\n"
+            "# TYPE app_errors_total counter\n"
+            "app_errors_total 1.0\n"
+        ) in body
+        assert "other_total 1.0\n" in body
+        assert "app_requests" not in body
+        assert "other_created" not in body
+
+
+class FailingCollector:
+    """
+    A collector that always fails.
+    """
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        raise ValueError("nope")
+
+
+class TestCountSeries:
+    @pytest.mark.parametrize(
+        "generate", [generate_latest, openmetrics.generate_latest]
+    )
+    def test_count(self, generate):
+        """
+        Every line that's not a comment is a series.
+        """
+        registry = CollectorRegistry()
+        Histogram("h", "h", buckets=[1, 2], registry=registry).observe(1)
+        Counter("c", "c", ["l"], registry=registry).labels("x").inc()
+
+        # 3 buckets, sum, count, created; total, created
+        assert 8 == _count_series(generate(registry))
+
+    def test_empty(self):
+        """
+        Empty expositions have no series.
+        """
+        assert 0 == _count_series(b"")
+
+
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+@pytest.mark.asyncio
+class TestInstrumentation:
+    @pytest.mark.parametrize("stream", [True, False])
+    async def test_start_http_server(self, stream):
+        """
+        Integration test: scrapes are measured, labelled by format.
+        """
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1", instrument=True, stream=stream
+        )
+
+        async with aiohttp.ClientSession() as s:
+            await (await s.get(server.url + "metrics")).read()
+            rv = await s.get(
+                server.url + "metrics",
+                headers={"Accept": "application/openmetrics-text"},
+            )
+            body = await rv.text()
+
+        await server.close()
+
+        assert (
+            'prometheus_async_scrape_duration_seconds_count{format="text"}'
+            in body
+        )
+        assert (
+            'prometheus_async_scrape_size_bytes_count{format="text"}' in body
+        )
+        assert 'prometheus_async_scrape_series{format="text"}' in body
+        assert (
+            'prometheus_async_scrapes_in_progress{format="openmetrics"} 1.0'
+            in body
+        )
+
+    async def test_uninstrumented(self):
+        """
+        Views that aren't instrumented don't create any scrape metrics.
+        """
+        view = aio.web._MetricsView(_Renderer(CollectorRegistry()))
+
+        assert None is view._scrape
+        assert [] == view.metrics
+
+    async def test_failures(self):
+        """
+        Failed renders are counted.
+        """
+        registry = CollectorRegistry()
+        registry.register(FailingCollector())
+        view = aio.web._MetricsView(_Renderer(registry), instrument=True)
+
+        with pytest.raises(ValueError, match="nope"):
+            await view(SimpleNamespace(headers=CIMultiDict()))
+
+        assert 1 == view._scrape.failures.labels("text")._value.get()
+
+
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+@pytest.mark.asyncio
+class TestMetricsMiddleware:
+    @pytest.fixture(name="client")
+    async def _client(self):
+        registry = CollectorRegistry()
+
+        async def ok(request):
+            return web.Response(text="hello")
+
+        async def forbidden(request):
+            raise web.HTTPForbidden
+
+        async def fail(request):
+            raise ValueError
+
+        async def stream(request):
+            rsp = web.StreamResponse()
+            await rsp.prepare(request)
+            await rsp.write(b"hello")
+
+            return rsp
+
+        app = web.Application(
+            middlewares=[aio.metrics_middleware(registry=registry)]
+        )
+        app.router.add_get("/users/{id}", ok)
+        app.router.add_get("/named", ok, name="named")
+        app.router.add_get("/forbidden", forbidden)
+        app.router.add_get("/fail", fail)
+        app.router.add_get("/stream", stream)
+        app.router.add_route("*", "/any", ok)
+
+        async with TestClient(TestServer(app)) as client:
+            yield client, registry
+
+    async def test_routes(self, client):
+        """
+        Requests are labelled by their route's canonical path or name, not
+        their raw path.
+        """
+        client, registry = client
+
+        for path in ("/users/1", "/users/2", "/named", "/nope"):
+            await (await client.get(path)).read()
+
+        def count(route, status):
+            return registry.get_sample_value(
+                "aiohttp_request_duration_seconds_count",
+                {"route": route, "method": "GET", "status": str(status)},
+            )
+
+        assert 2 == count("/users/{id}", 200)
+        assert 1 == count("named", 200)
+        assert 1 == count("", 404)
+        assert 10 == registry.get_sample_value(
+            "aiohttp_response_size_bytes_sum",
+            {"route": "/users/{id}", "method": "GET", "status": "200"},
+        )
+        assert 0 == registry.get_sample_value(
+            "aiohttp_requests_in_progress",
+            {"route": "/users/{id}", "method": "GET"},
+        )
+
+    @pytest.mark.parametrize(
+        ("path", "status"), [("/forbidden", 403), ("/fail", 500)]
+    )
+    async def test_errors(self, client, path, status):
+        """
+        Raised HTTP exceptions are recorded with their status, other
+        exceptions as 500.
+        """
+        client, registry = client
+
+        rv = await client.get(path)
+
+        assert status == rv.status
+        assert 1 == registry.get_sample_value(
+            "aiohttp_request_duration_seconds_count",
+            {"route": path, "method": "GET", "status": str(status)},
+        )
+
+    async def test_methods(self, client):
+        """
+        Non-standard request methods are recorded as "other".
+        """
+        client, registry = client
+
+        for method in ("POST", "PURGE", "PROPFIND"):
+            await (await client.request(method, "/any")).read()
+
+        def count(method):
+            return registry.get_sample_value(
+                "aiohttp_request_duration_seconds_count",
+                {"route": "/any", "method": method, "status": "200"},
+            )
+
+        assert 1 == count("POST")
+        assert 2 == count("other")
+        assert None is count("PURGE")
+
+    async def test_streamed(self, client):
+        """
+        Responses without a content length have no size.
+        """
+        client, registry = client
+        labels = {"route": "/stream", "method": "GET", "status": "200"}
+
+        await (await client.get("/stream")).read()
+
+        assert 1 == registry.get_sample_value(
+            "aiohttp_request_duration_seconds_count", labels
+        )
+        assert 0 == registry.get_sample_value(
+            "aiohttp_response_size_bytes_count", labels
+        )
+
+
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+@pytest.mark.asyncio
+class TestTraceConfig:
+    @pytest.fixture(name="server")
+    async def _server(self):
+        async def slow(request):
+            await asyncio.sleep(0.05)
+            return web.Response(text="hello")
+
+        async def redirect(request):
+            raise web.HTTPFound("/")
+
+        app = web.Application()
+        app.router.add_get("/", slow)
+        app.router.add_get("/redirect", redirect)
+
+        async with TestServer(app, host="127.0.0.1") as server:
+            yield server
+
+    @pytest.mark.parametrize(
+        ("max_hosts", "host"), [(100, "127.0.0.1"), (0, "other")]
+    )
+    async def test_trace(self, server, max_hosts, host):
+        """
+        The phases of outgoing requests are recorded, labelled by host and
+        method.  Hosts beyond max_hosts are lumped together.
+        """
+        registry = CollectorRegistry()
+        tc = aio.trace_config(registry=registry, max_hosts=max_hosts)
+
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=1), trace_configs=[tc]
+        ) as s:
+            rvs = await asyncio.gather(
+                s.get(server.make_url("/")), s.get(server.make_url("/"))
+            )
+            for rv in rvs:
+                await rv.read()
+
+        def value(name, **labels):
+            return registry.get_sample_value(
+                f"aiohttp_client_{name}_seconds_count",
+                {"host": host, "method": "GET", **labels},
+            )
+
+        assert 2 == value("request_duration", outcome="ok")
+        assert 0 == value("request_duration", outcome="error")
+        assert 2 == value("time_to_first_byte")
+        assert 1 == value("connection_create")
+        assert 1 == value("connection_queued")
+        assert 0.05 <= registry.get_sample_value(
+            "aiohttp_client_request_duration_seconds_sum",
+            {"host": host, "method": "GET", "outcome": "ok"},
+        )
+
+    async def test_redirect(self, server):
+        """
+        Redirects are part of the request.
+        """
+        registry = CollectorRegistry()
+        labels = {"host": "127.0.0.1", "method": "GET", "outcome": "ok"}
+
+        async with aiohttp.ClientSession(
+            trace_configs=[aio.trace_config(registry=registry)]
+        ) as s:
+            await (await s.get(server.make_url("/redirect"))).read()
+
+        assert 1 == registry.get_sample_value(
+            "aiohttp_client_request_duration_seconds_count", labels
+        )
+        assert 0.05 <= registry.get_sample_value(
+            "aiohttp_client_request_duration_seconds_sum", labels
+        )
+
+    async def test_dns(self, server):
+        """
+        Resolving host names is recorded.
+        """
+        registry = CollectorRegistry()
+
+        async with aiohttp.ClientSession(
+            trace_configs=[aio.trace_config(registry=registry)]
+        ) as s:
+            url = server.make_url("/").with_host("localhost")
+            await (await s.get(url)).read()
+
+        assert 1 == registry.get_sample_value(
+            "aiohttp_client_dns_resolution_seconds_count",
+            {"host": "localhost", "method": "GET"},
+        )
+
+    async def test_exception(self, server):
+        """
+        Failed requests are recorded as errors -- including the time they
+        spent waiting for a connection.
+        """
+        registry = CollectorRegistry()
+        labels = {"host": "127.0.0.1", "method": "GET"}
+
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=1),
+            trace_configs=[aio.trace_config(registry=registry)],
+        ) as s:
+            slow = asyncio.create_task(s.get(server.make_url("/")))
+            await asyncio.sleep(0.01)
+            with pytest.raises(asyncio.TimeoutError):
+                await s.get(
+                    server.make_url("/"),
+                    timeout=aiohttp.ClientTimeout(total=0.01),
+                )
+            await (await slow).read()
+
+            with socket.socket() as sock:
+                sock.bind(("127.0.0.1", 0))
+                port = sock.getsockname()[1]
+            with pytest.raises(aiohttp.ClientConnectionError):
+                await s.get(f"http://127.0.0.1:{port}/")
+
+        def count(name, **extra):
+            return registry.get_sample_value(
+                f"aiohttp_client_{name}_seconds_count", {**labels, **extra}
+            )
+
+        assert 2 == count("request_duration", outcome="error")
+        assert 1 == count("request_duration", outcome="ok")
+        assert 1 == count("connection_queued")
+
+    async def test_end_without_headers(self):
+        """
+        If no headers have been sent, only the request duration is recorded.
+        """
+        registry = CollectorRegistry()
+        metrics = _ClientMetrics(registry, "test", 1)
+        ctx = SimpleNamespace(
+            start=0.0, children=metrics._labelled("h", "GET")
+        )
+
+        await metrics.on_request_end(None, ctx, None)
+
+        assert 0 == registry.get_sample_value(
+            "test_time_to_first_byte_seconds_count",
+            {"host": "h", "method": "GET"},
+        )
+        assert 1 == registry.get_sample_value(
+            "test_request_duration_seconds_count",
+            {"host": "h", "method": "GET", "outcome": "ok"},
+        )
+
+
+@pytest.mark.asyncio
+class TestLoopMonitor:
+    async def test_lag(self):
+        """
+        Blocking the loop shows up as lag and late heartbeats, and the
+        pending tasks are counted.
+        """
+        registry = CollectorRegistry()
+        monitor = await aio.start_loop_monitor(
+            interval=0.01, late_threshold=0.02, registry=registry
+        )
+
+        await asyncio.sleep(0.005)
+        blocking_time.sleep(0.05)  # noqa: ASYNC251
+        await asyncio.sleep(0.03)
+
+        late = registry.get_sample_value(
+            "asyncio_event_loop_late_heartbeats_total"
+        )
+        lag = registry.get_sample_value("asyncio_event_loop_lag_seconds_sum")
+        tasks = registry.get_sample_value("asyncio_event_loop_tasks")
+        await monitor.close()
+
+        assert 1 <= late
+        assert 0.02 <= lag
+        assert 1 <= tasks
+
+    async def test_tasks_on_collect(self):
+        """
+        Tasks are counted when collected, not by the heartbeat.  Monitors
+        don't have to be registered.
+        """
+        monitor = await aio.start_loop_monitor(interval=60, registry=None)
+        registry = CollectorRegistry()
+        registry.register(monitor)
+
+        before = registry.get_sample_value("asyncio_event_loop_tasks")
+        task = asyncio.create_task(asyncio.sleep(60))
+        after = registry.get_sample_value("asyncio_event_loop_tasks")
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await monitor.close()
+
+        assert 1 <= before
+        assert before + 1 == after
+
+    async def test_register_fails(self):
+        """
+        If the monitor can't be registered, no heartbeat is left behind.
+        """
+        registry = CollectorRegistry()
+        with mock.patch.object(
+            aio._loop.LoopMonitor, "_beat", autospec=True
+        ) as beat:
+            monitor = await aio.start_loop_monitor(
+                interval=0.01, registry=registry
+            )
+
+            with pytest.raises(ValueError, match="Duplicated timeseries"):
+                await aio.start_loop_monitor(interval=0.01, registry=registry)
+
+            await monitor.close()
+            await asyncio.sleep(0.02)
+
+        assert 0 == beat.call_count
+
+    async def test_close(self):
+        """
+        Closing stops the heartbeat and unregisters the monitor.  Closing
+        again is a no-op.
+        """
+        registry = CollectorRegistry()
+        monitor = await aio.start_loop_monitor(
+            interval=0.01, registry=registry
+        )
+
+        await monitor.close()
+        await monitor.close()
+        await asyncio.sleep(0.02)
+
+        assert [] == list(registry.collect())
+        assert 0 == monitor._lag._sum.get()
+
+
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+@pytest.mark.asyncio
+class TestMultiprocess:
+    async def test_start_http_server(self, mp_dir):
+        """
+        Integration test: the aggregated metrics of all processes are served.
+        """
+        for pid, value in ((1, 1.0), (2, 2.0)):
+            close(write_counter(pid, value))
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1", multiprocess=True
+        )
+
+        async with aiohttp.ClientSession() as s:
+            body = await (await s.get(server.url + "metrics")).text()
+
+        await server.close()
+
+        assert "mp_total 3.0" in body
+
+    async def test_restricted(self, mp_dir):
+        """
+        Integration test: the aggregated metrics can be selected.
+        """
+        close(write_counter(1, 1.0))
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1", multiprocess=True
+        )
+
+        async with aiohttp.ClientSession() as s:
+            rv = await s.get(
+                server.url + "metrics", params={"name[]": "mp_total"}
+            )
+            body = await rv.text()
+
+        await server.close()
+
+        assert "mp_total 1.0\n" in body
+
+    async def test_own_metrics(self, mp_values):
+        """
+        Our own metrics are collected from the multiprocess files only and
+        thus exposed exactly once.
+        """
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1",
+            multiprocess=True,
+            render_in_thread=True,
+            instrument=True,
+            max_concurrent_renders=1,
+            collector_timing=True,
+        )
+
+        async with aiohttp.ClientSession() as s:
+            for _ in range(2):
+                body = await (await s.get(server.url + "metrics")).text()
+
+        await server.close()
+
+        types = [
+            line for line in body.splitlines() if line.startswith("# TYPE")
+        ]
+
+        assert len(types) == len(set(types))
+        assert "prometheus_async_render_duration_seconds_count 1.0" in body
+        assert (
+            'prometheus_async_scrapes_in_progress{format="text"} 1.0' in body
+        )
+        assert "# TYPE prometheus_async_collector_duration_seconds" in body
+
+    async def test_registry(self, mp_dir):
+        """
+        multiprocess can't be combined with registry.
+        """
+        with pytest.raises(ValueError, match="registry"):
+            await aio.web.start_http_server(
+                registry=CollectorRegistry(), multiprocess=True
+            )
+
+
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+class TestIterChunks:
+    @pytest.mark.parametrize(
+        "generate", [generate_latest, openmetrics.generate_latest]
+    )
+    @pytest.mark.parametrize("size", [1, 64 * 1024])
+    def test_iter_chunks(self, generate, size):
+        """
+        The chunks add up to the same exposition as a complete render.
+        """
+        for i in range(10):
+            Counter(f"test_iter_chunks_{i}", "cnt", ["l"]).labels("x").inc(i)
+
+        chunks = list(_iter_chunks(REGISTRY, generate, size=size))
+
+        assert generate(REGISTRY) == b"".join(chunks)
+        if size == 1:
+            assert len(chunks) == (
+                11 if generate is openmetrics.generate_latest else 10
+            )
+
+
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+class TestCollectorTiming:
+    @pytest.mark.parametrize(
+        "generate", [generate_latest, openmetrics.generate_latest]
+    )
+    def test_timed_chunks(self, generate):
+        """
+        Instrumented renders produce the same exposition -- including target
+        info -- and record durations per collector.
+        """
+        registry = CollectorRegistry(target_info={"env": "test"})
+        Counter("test_timed", "cnt", registry=registry).inc()
+        registry.register(ThreadRecordingCollector())
+        durations = {}
+
+        chunks = list(_iter_chunks(registry, generate, durations=durations))
+
+        assert generate(registry) == b"".join(chunks)
+        assert {"test_timed", "ThreadRecordingCollector"} == set(durations)
+        assert all(d >= 0 for ds in durations.values() for d in ds)
+
+    def test_same_key(self):
+        """
+        Collectors with the same key are numbered instead of merged.
+        """
+        registry = CollectorRegistry()
+        registry.register(ThreadRecordingCollector())
+        registry.register(ThreadRecordingCollector())
+        durations = {}
+
+        list(_iter_chunks(registry, generate_latest, durations=durations))
+
+        assert {
+            "ThreadRecordingCollector",
+            "ThreadRecordingCollector-2",
+        } == set(durations)
+
+    def test_single_collector(self):
+        """
+        A collector that isn't a registry is timed as a whole.
+        """
+        collector = ThreadRecordingCollector()
+        durations = {}
+
+        chunks = list(
+            _iter_chunks(collector, generate_latest, durations=durations)
+        )
+
+        assert b"thread_recording 1.0\n" in b"".join(chunks)
+        assert ["ThreadRecordingCollector"] == list(durations)
+
+    async def test_exposed(self):
+        """
+        The durations of the latest render are exposed through the registry.
+        """
+        registry = CollectorRegistry()
+        Counter("test_timed", "cnt", registry=registry).inc()
+        r = _Renderer(registry, collector_timing=True)
+        for m in r.metrics:
+            registry.register(m)
+
+        await r.render(generate_latest)
+        body = (await r.render(generate_latest)).body
+
+        assert (
+            b'prometheus_async_collector_duration_seconds{collector="test_timed"'
+            b',phase="collect"}' in body
+        )
+        assert {
+            "test_timed",
+            "prometheus_async_collector_duration_seconds",
+        } == set(r.timings.latest)
+
+    async def test_stream(self):
+        """
+        Streamed renders record the durations, too -- unless they're
+        restricted.
+        """
+        registry = CollectorRegistry()
+        Counter("test_timed", "cnt", registry=registry).inc()
+        r = _Renderer(registry, collector_timing=True)
+
+        [c async for c in r.stream(generate_latest, ["test_timed_total"], [])]
+
+        assert {} == r.timings.latest
+
+        [c async for c in r.stream(generate_latest)]
+
+        assert "test_timed" in r.timings.latest
+
+    async def test_lifecycle(self):
+        """
+        The timings belong to their server: they're unregistered on close, so
+        the next server exposes its own.
+        """
+        Counter("test_timed", "cnt").inc()
+        for _ in range(2):
+            server = await aio.web.start_http_server(
+                addr="127.0.0.1", collector_timing=True
+            )
+
+            async with aiohttp.ClientSession() as s:
+                await (await s.get(server.url + "metrics")).read()
+
+            assert None is not REGISTRY.get_sample_value(
+                "prometheus_async_collector_duration_seconds",
+                {"collector": "test_timed", "phase": "collect"},
+            )
+
+            await server.close()
+
+            assert None is REGISTRY.get_sample_value(
+                "prometheus_async_collector_duration_seconds",
+                {"collector": "test_timed", "phase": "collect"},
+            )
+
+    def test_key_without_families(self):
+        """
+        Collectors that describe no families are keyed by their class.
+        """
+        assert "FailingCollector" == _collector_key(FailingCollector())
+
+    async def test_start_http_server(self):
+        """
+        Integration test: the timings are available as JSON.
+        """
+        Counter("test_timed", "cnt").inc()
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1", collector_timing=True, render_in_thread=True
+        )
+
+        async with aiohttp.ClientSession() as s:
+            await (await s.get(server.url + "metrics")).read()
+            rv = await s.get(server.url + "debug/collectors")
+            timings = await rv.json()
+            unknown = await s.get(
+                server.url + "debug/collectors", params={"path": "/nope"}
+            )
+
+        await server.close()
+
+        assert 404 == unknown.status
+
+        assert "test_timed" in [t["collector"] for t in timings]
+        assert {"collector", "collect_seconds", "encode_seconds"} == set(
+            timings[0]
+        )
+
+
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+@pytest.mark.asyncio
+class TestStreaming:
+    @pytest.mark.parametrize(
+        ("compress", "accept_encoding", "encoding"),
+        [
+            (True, "gzip", "gzip"),
+            (True, "identity", None),
+            (False, "gzip", None),
+        ],
+    )
+    async def test_start_http_server(
+        self, compress, accept_encoding, encoding
+    ):
+        """
+        Integration test: the metrics server streams the exposition using
+        chunked transfer encoding -- compressed if enabled and accepted.
+        """
+        for i in range(100):
+            Counter(f"test_streamed_{i}_total", "cnt").inc(i)
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1", stream=True, compress=compress
+        )
+
+        async with aiohttp.ClientSession() as s:
+            rv = await s.get(
+                server.url + "metrics",
+                headers={
+                    "Accept": "application/openmetrics-text",
+                    "Accept-Encoding": accept_encoding,
+                },
+            )
+            body = await rv.read()
+
+        await server.close()
+
+        assert "chunked" == rv.headers["Transfer-Encoding"]
+        assert openmetrics.CONTENT_TYPE_LATEST == rv.headers["Content-Type"]
+        assert encoding == rv.headers.get("Content-Encoding")
+        assert 1 == body.count(b"# EOF\n")
+        assert body.endswith(b"# EOF\n")
+        assert b"test_streamed_99_total 99.0\n" in body
+
+    async def test_render_in_thread(self):
+        """
+        Streaming works with off-loop rendering.
+        """
+        collector = ThreadRecordingCollector()
+        REGISTRY.register(collector)
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1", stream=True, render_in_thread=True
+        )
+
+        async with aiohttp.ClientSession() as s:
+            rv = await s.get(server.url + "metrics")
+            body = await rv.text()
+
+        await server.close()
+
+        assert collector.threads[-1].startswith("PrometheusAsyncRender")
+        assert "thread_recording 1.0" in body
+
+
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+@pytest.mark.asyncio
+class TestRenderer:
+    async def test_unchanged_render_reuses_snapshot(self):
+        """
+        If a render is identical to the previous one, the previous snapshot
+        is returned.
+        """
+        Counter("test_unchanged_total", "cnt")
+        r = _Renderer(REGISTRY, keep_latest=True)
+
+        s1 = await r.render(openmetrics.generate_latest)
+        s2 = await r.render(openmetrics.generate_latest)
+
+        assert s1 is s2
+
+    async def test_latest_not_kept(self):
+        """
+        If no feature needs it, the latest snapshot isn't kept.
+        """
+        r = _Renderer(REGISTRY)
+
+        s1 = await r.render(generate_latest)
+        s2 = await r.render(generate_latest)
+
+        assert s1 is not s2
+        assert s1.body == s2.body
+        assert {} == r._latest
+        assert {} == aio.web._SERVER_STATS._renderer._latest
+
+    async def test_forget_replaced(self):
+        """
+        A finished render doesn't forget a render that replaced it -- e.g.
+        one for a different event loop.
+        """
+        r = _Renderer(REGISTRY)
+        old = asyncio.create_task(r._snapshot(generate_latest))
+        new = asyncio.create_task(r._snapshot(generate_latest))
+        await asyncio.gather(old, new)
+        r._in_flight[generate_latest] = new
+
+        r._forget(generate_latest, old)
+
+        assert new is r._in_flight[generate_latest]
+
+    async def test_prerender_serves_latest(self):
+        """
+        While pre-rendering, scrapes are served the latest snapshot.
+        """
+        collector = CountingCollector()
+        REGISTRY.register(collector)
+        collector.calls = 0
+        r = _Renderer(REGISTRY, prerender_interval=3600)
+        await r.start()
+
+        s1 = await r.render(generate_latest)
+        s2 = await r.render(generate_latest)
+
+        await r.close()
+
+        assert s1 is s2
+        assert 1 == collector.calls
+
+    async def test_prerender_max_staleness(self):
+        """
+        Snapshots that are older than max_staleness are re-rendered.
+        """
+        collector = CountingCollector()
+        REGISTRY.register(collector)
+        collector.calls = 0
+        r = _Renderer(REGISTRY, prerender_interval=3600, max_staleness=0)
+        await r.start()
+
+        s1 = await r.render(generate_latest)
+        s2 = await r.render(generate_latest)
+
+        await r.close()
+
+        assert s1 is not s2
+        assert 2 == collector.calls
+
+    async def test_prerender_background(self):
+        """
+        Requested formats are re-rendered in the background until the
+        renderer is closed.
+        """
+        collector = CountingCollector()
+        REGISTRY.register(collector)
+        collector.calls = 0
+        r = _Renderer(REGISTRY, prerender_interval=0.001)
+        await r.start()
+
+        await r.render(openmetrics.generate_latest)
+        await asyncio.sleep(0.05)
+        await r.close()
+        calls = collector.calls
+        await asyncio.sleep(0.01)
+
+        assert calls > 2
+        assert calls == collector.calls
+
+    async def test_prerender_start_http_server(self):
+        """
+        Integration test: the metrics server pre-renders.
+        """
+        collector = CountingCollector()
+        REGISTRY.register(collector)
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1", prerender_interval=3600
+        )
+
+        async with aiohttp.ClientSession() as s:
+            for _ in range(3):
+                rv = await s.get(server.url + "metrics")
+                body = await rv.text()
+
+        await server.close()
+
+        assert "counting 2.0" in body
+
+
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+@pytest.mark.asyncio
+class TestConsulAgent:
+    @pytest.mark.parametrize("deregister", [True, False])
+    async def test_integration(self, deregister):
+        """
+        Integration test with a real consul agent. Start a service, register
+        it, close it, verify it's deregistered.
+        """
+        tags = ("foo", "bar")
+        service_id = str(uuid.uuid4())  # allow for parallel tests
+
+        con = _LocalConsulAgentClient(token=None)
+        ca = ConsulAgent(
+            name="test-metrics",
+            service_id=service_id,
+            tags=tags,
+            deregister=deregister,
+        )
+
+        try:
+            server = await aio.web.start_http_server(
+                addr="127.0.0.1", service_discovery=ca
+            )
+        except aiohttp.ClientOSError:
+            pytest.skip("Missing consul agent.")
+
+        svc = (await con.get_services())[service_id]
+
+        assert "test-metrics" == svc["Service"]
+        assert sorted(tags) == sorted(svc["Tags"])
+        assert server.socket.addr == svc["Address"]
+        assert server.socket.port == svc["Port"]
+
+        await server.close()
+
+        services = await con.get_services()
+
+        if deregister:
+            # Assert service is gone iff we are supposed to deregister.
+            assert service_id not in services
+        else:
+            assert service_id in services
+
+            # Clean up behind ourselves.
+            resp = await con.deregister_service(service_id)
+            assert 200 == resp.status
+
+    @pytest.mark.parametrize("deregister", [True, False])
+    @pytest.mark.skipif(sys.version_info < (3, 8), reason="AsyncMock is 3.8+")
+    async def test_mocked(self, deregister):
+        """
+        Same as test_integration, but using mocks instead of a real consul
+        agent.
+        """
+        tags = ("foo", "bar")
+        service_id = str(uuid.uuid4())  # allow for parallel tests
+
+        con = mock.AsyncMock(auto_spec=_LocalConsulAgentClient)
+        ca = ConsulAgent(
+            name="test-metrics",
+            service_id=service_id,
+            tags=tags,
+            deregister=deregister,
+        )
+        ca.consul = con
+
+        server = await aio.web.start_http_server(
+            addr="127.0.0.1", service_discovery=ca
+        )
+
+        con.register_service.assert_awaited_once()
+        reg = con.register_service.await_args.kwargs
+
+        assert service_id == reg["service_id"]
+        assert "test-metrics" == reg["name"]
+        assert sorted(tags) == sorted(reg["tags"])
+        assert (
+            f"http://{server.socket.addr}:{server.socket.port}/"
+            == reg["metrics_server"].url
+        )
+
+        await server.close()
+
+        if deregister:
+            # Assert service is gone iff we are supposed to deregister.
+            con.deregister_service.assert_awaited_once_with(service_id)
+        else:
+            con.deregister_service.assert_not_called()
+
+    async def test_none_if_register_fails(self):
+        """
+        If register fails, return None.
+        """
+
+        class FakeMetricsServer:
+            socket = mock.Mock(addr="127.0.0.1", port=12345)
+            url = "http://127.0.0.1:12345/metrics"
+
+        class FakeSession:
+            async def __aexit__(self, exc_type, exc_value, traceback):
+                pass
+
+            async def __aenter__(self):
+                class FakeConnection:
+                    async def put(self, *args, **kw):
+                        return mock.Mock(status=400)
+
+                return FakeConnection()
+
+        ca = ConsulAgent()
+        ca.consul.session_factory = FakeSession
+
+        assert None is (await ca.register(FakeMetricsServer()))
+
+
+@pytest.mark.skipif(aiohttp is None, reason="Needs aiohttp.")
+class TestLocalConsulAgentClient:
+    def test_sets_headers(self):
+        """
+        If a token is passed, "X-Consul-Token" header is set.
+        """
+        con = _LocalConsulAgentClient(token="token42")
+
+        assert "token42" == con.headers["X-Consul-Token"]
+
+    async def test_register_unix(self):
+        """
+        Metrics servers that only listen on a Unix domain socket can't be
+        registered.
+        """
+        con = _LocalConsulAgentClient(token=None)
+
+        with pytest.raises(ValueError, match="TCP"):
+            await con.register_service(
+                "name", "id", None, SimpleNamespace(socket="/metrics.sock")
+            )
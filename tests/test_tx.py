@@ -16,9 +16,19 @@
 
 import functools
 
+from unittest import mock
+
 import pytest
 
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter
+from prometheus_client.openmetrics.exposition import (
+    CONTENT_TYPE_LATEST as OPENMETRICS_CONTENT_TYPE,
+)
 from twisted.internet.defer import Deferred, Failure, fail, succeed
+from twisted.internet.task import Clock
+from twisted.internet.testing import MemoryReactor
+from twisted.python.threadpool import ThreadPool
+from twisted.web.test.requesthelper import DummyRequest
 
 from prometheus_async import tx
 
@@ -306,3 +316,387 @@ class TestTrackInprogress:
         assert 42 == rv
         assert 0 == fake_gauge._val
         assert 2 == fake_gauge._calls
+
+
+class FakeThreadPool:
+    """
+    A thread pool that runs functions when told to.
+    """
+
+    def __init__(self):
+        self.pending = []
+
+    def callInThreadWithCallback(self, on_result, f, *args, **kw):
+        def run():
+            try:
+                rv = f(*args, **kw)
+            except Exception:
+                on_result(False, Failure())
+            else:
+                on_result(True, rv)
+
+        self.pending.append(run)
+
+    def run_pending(self):
+        pending, self.pending = self.pending, []
+        for run in pending:
+            run()
+
+
+class FakeReactor:
+    def __init__(self):
+        self.pool = FakeThreadPool()
+
+    def getThreadPool(self):
+        return self.pool
+
+    def callFromThread(self, f, *args, **kw):
+        f(*args, **kw)
+
+
+@pytest.fixture(name="registry")
+def _registry():
+    registry = CollectorRegistry()
+    Counter("tx_test", "Test counter.", registry=registry).inc()
+
+    return registry
+
+
+@pytest.fixture(name="reactor")
+def _reactor():
+    return FakeReactor()
+
+
+class TestMetricsResource:
+    def test_renders_in_pool(self, registry, reactor):
+        """
+        The metrics are rendered in the reactor's thread pool and written
+        once the render is done.
+        """
+        resource = tx.web.MetricsResource(registry, reactor)
+        request = DummyRequest([b""])
+
+        rv = request.render(resource)
+
+        assert b"" == b"".join(request.written)
+        assert 0 == request.finished
+
+        reactor.pool.run_pending()
+        body = b"".join(request.written)
+
+        assert rv is None
+        assert b"tx_test_total 1.0" in body
+        assert 1 == request.finished
+        assert (
+            CONTENT_TYPE_LATEST.encode()
+            == request.responseHeaders.getRawHeaders(b"Content-Type")[0]
+        )
+
+    def test_openmetrics(self, registry, reactor):
+        """
+        OpenMetrics is served if the client asks for it.
+        """
+        resource = tx.web.MetricsResource(registry, reactor)
+        request = DummyRequest([b""])
+        request.requestHeaders.setRawHeaders(
+            b"Accept", [b"application/openmetrics-text"]
+        )
+
+        request.render(resource)
+        reactor.pool.run_pending()
+
+        assert b"".join(request.written).endswith(b"# EOF\n")
+        assert (
+            OPENMETRICS_CONTENT_TYPE.encode()
+            == request.responseHeaders.getRawHeaders(b"Content-Type")[0]
+        )
+
+    def test_coalesces(self, registry, reactor):
+        """
+        Concurrent requests for the same format share one render, different
+        formats don't.
+        """
+        resource = tx.web.MetricsResource(registry, reactor)
+        r1, r2, r3 = (DummyRequest([b""]) for _ in range(3))
+        r3.requestHeaders.setRawHeaders(
+            b"Accept", [b"application/openmetrics-text"]
+        )
+
+        for r in (r1, r2, r3):
+            r.render(resource)
+
+        assert 2 == len(reactor.pool.pending)
+
+        reactor.pool.run_pending()
+
+        assert r1.written == r2.written
+        assert r1.written != r3.written
+        assert 1 == r1.finished == r2.finished == r3.finished
+
+        # Once done, the next request renders anew.
+        r4 = DummyRequest([b""])
+        r4.render(resource)
+
+        assert 1 == len(reactor.pool.pending)
+
+    def test_failure(self, reactor):
+        """
+        If rendering fails, all waiting requests get a 500 and the error is
+        logged.
+        """
+
+        class BrokenRegistry(CollectorRegistry):
+            def collect(self):
+                raise ValueError("broken")
+
+        resource = tx.web.MetricsResource(BrokenRegistry(), reactor)
+        r1, r2 = DummyRequest([b""]), DummyRequest([b""])
+
+        r1.render(resource)
+        r2.render(resource)
+        reactor.pool.run_pending()
+
+        assert 500 == r1.responseCode == r2.responseCode
+        assert [] == r1.written == r2.written
+        assert 1 == r1.finished == r2.finished
+
+    def test_gone(self, registry, reactor):
+        """
+        Requests whose clients disconnected before the render finished are
+        left alone.
+        """
+        resource = tx.web.MetricsResource(registry, reactor)
+        request = DummyRequest([b""])
+
+        request.render(resource)
+        request.processingFailed(Failure(ConnectionError("gone")))
+        reactor.pool.run_pending()
+
+        assert [] == request.written
+        assert 0 == request.finished
+
+    def test_gone_failure(self, reactor):
+        """
+        Requests whose clients disconnected before the render failed are
+        left alone, too.
+        """
+
+        class BrokenRegistry(CollectorRegistry):
+            def collect(self):
+                raise ValueError("broken")
+
+        resource = tx.web.MetricsResource(BrokenRegistry(), reactor)
+        request = DummyRequest([b""])
+
+        request.render(resource)
+        request.processingFailed(Failure(ConnectionError("gone")))
+        reactor.pool.run_pending()
+
+        assert 500 != request.responseCode
+        assert 0 == request.finished
+
+    def test_global_reactor(self, registry):
+        """
+        The global reactor is used by default.
+        """
+        from twisted.internet import reactor
+
+        resource = tx.web.MetricsResource(registry)
+
+        assert reactor is resource._renderer._reactor
+
+
+class TestStartHTTPServer:
+    def test_listens(self, registry):
+        """
+        start_http_server listens on the passed address and serves a
+        MetricsResource at /metrics.
+        """
+        reactor = MemoryReactor()
+
+        tx.web.start_http_server(
+            addr="127.0.0.1", port=8000, registry=registry, reactor=reactor
+        )
+
+        ((port, site, _, interface),) = reactor.tcpServers
+        resource = site.resource.getStaticEntity(b"metrics")
+
+        assert 8000 == port
+        assert "127.0.0.1" == interface
+        assert isinstance(resource, tx.web.MetricsResource)
+        assert registry is resource._renderer._registry
+
+    def test_global_reactor(self, registry):
+        """
+        The global reactor is used by default.
+        """
+        port = tx.web.start_http_server(addr="127.0.0.1", registry=registry)
+
+        try:
+            assert "127.0.0.1" == port.getHost().host
+        finally:
+            port.stopListening()
+
+
+class ClockWithThreadPool(Clock):
+    def __init__(self):
+        super().__init__()
+        self.pool = ThreadPool(minthreads=0, maxthreads=4)
+
+    def getThreadPool(self):
+        return self.pool
+
+
+class TestReactorMonitor:
+    def test_lag(self):
+        """
+        A blocked reactor shows up as lag and late heartbeats.
+        """
+        registry = CollectorRegistry()
+        clock = ClockWithThreadPool()
+        monitor = tx.start_reactor_monitor(
+            interval=1,
+            late_threshold=0.5,
+            registry=registry,
+            reactor=clock,
+        )
+
+        clock.advance(1)
+
+        assert 0 == registry.get_sample_value(
+            "twisted_reactor_lag_seconds_sum"
+        )
+
+        # Block the reactor: the heartbeat due at 2 runs at 4.5.
+        clock.advance(3.5)
+
+        assert 2.5 == registry.get_sample_value(
+            "twisted_reactor_lag_seconds_sum"
+        )
+        assert 1 == registry.get_sample_value(
+            "twisted_reactor_late_heartbeats_total"
+        )
+
+        # Back on the grid.
+        clock.advance(0.5)
+
+        assert 3 == registry.get_sample_value(
+            "twisted_reactor_lag_seconds_count"
+        )
+
+        clock.advance(1)
+
+        assert 2.5 == registry.get_sample_value(
+            "twisted_reactor_lag_seconds_sum"
+        )
+        assert 4 == registry.get_sample_value(
+            "twisted_reactor_lag_seconds_count"
+        )
+
+        monitor.close()
+
+    def test_thread_pool(self):
+        """
+        Queued calls, busy workers, and the utilization of the reactor's
+        thread pool are read on collection.
+        """
+        registry = CollectorRegistry()
+        clock = ClockWithThreadPool()
+        monitor = tx.start_reactor_monitor(registry=registry, reactor=clock)
+
+        # The pool isn't started, so calls queue up.
+        clock.pool.callInThread(lambda: None)
+        clock.pool.callInThread(lambda: None)
+
+        assert 2 == registry.get_sample_value(
+            "twisted_threadpool_queued_calls"
+        )
+        assert 0 == registry.get_sample_value(
+            "twisted_threadpool_busy_workers"
+        )
+        assert 0 == registry.get_sample_value(
+            "twisted_threadpool_utilization_ratio"
+        )
+
+        monitor.close()
+
+    def test_close(self):
+        """
+        Closing stops the heartbeat and unregisters the monitor.  Closing
+        again is a no-op.
+        """
+        registry = CollectorRegistry()
+        clock = ClockWithThreadPool()
+        monitor = tx.start_reactor_monitor(registry=registry, reactor=clock)
+
+        monitor.close()
+        monitor.close()
+
+        assert [] == list(registry.collect())
+        assert [] == clock.getDelayedCalls()
+
+    def test_register_fails(self):
+        """
+        If the monitor can't be registered, no heartbeat is left behind.
+        """
+        registry = CollectorRegistry()
+        clock = ClockWithThreadPool()
+        monitor = tx.start_reactor_monitor(registry=registry, reactor=clock)
+
+        with pytest.raises(ValueError, match="Duplicated timeseries"):
+            tx.start_reactor_monitor(registry=registry, reactor=clock)
+
+        monitor.close()
+
+        assert [] == clock.getDelayedCalls()
+
+    def test_close_after_failed_beat(self):
+        """
+        If the heartbeat failed and stopped, closing still unregisters the
+        monitor.
+        """
+        registry = CollectorRegistry()
+        clock = ClockWithThreadPool()
+        monitor = tx.start_reactor_monitor(
+            interval=1, registry=registry, reactor=clock
+        )
+
+        with mock.patch.object(
+            monitor._lag, "observe", side_effect=RuntimeError
+        ):
+            clock.advance(1)
+
+        assert False is monitor._call.running
+
+        monitor.close()
+
+        assert [] == list(registry.collect())
+
+    def test_unregistered(self):
+        """
+        Monitors don't have to be registered and handle thread pools
+        without workers.
+        """
+        clock = ClockWithThreadPool()
+        clock.pool = ThreadPool(minthreads=0, maxthreads=0)
+        monitor = tx.start_reactor_monitor(registry=None, reactor=clock)
+        registry = CollectorRegistry()
+        registry.register(monitor)
+
+        assert 0 == registry.get_sample_value(
+            "twisted_threadpool_utilization_ratio"
+        )
+
+        monitor.close()
+
+    def test_global_reactor(self):
+        """
+        The global reactor is monitored by default.
+        """
+        from twisted.internet import reactor
+
+        monitor = tx.start_reactor_monitor(registry=None)
+
+        assert reactor is monitor._reactor
+
+        monitor.close()